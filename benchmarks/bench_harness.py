@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""Measures the overhead testrunner.py itself adds to each test.
+
+Synthetic testsuites are generated and the time spent in each phase of
+the testrunner is measured separately:
+
+  load     - executing the testsuite files, execpyfile() and DefTest()
+  filter   - selecting tests with -k patterns, filter_tests()
+  execute  - running the tests, run_tests()
+  compare  - comparing the output with the expected output, diff()
+  log      - writing the text, XML and JSON Lines logs
+
+The harness overhead per test is the execution time not spent in the
+test commands themselves. The results can be saved with --output and
+compared against an earlier run with --baseline to catch performance
+regressions in the testrunner.
+"""
+import sys
+import os
+import time
+import json
+import optparse
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import testrunner
+
+DEFAULT_SIZES = '1000,10000,100000'
+NUM_PATTERNS = 100
+LARGE_OUTPUT_SIZE = 64 * 1024 * 1024
+LARGE_OUTPUT_TESTS = 4
+#Differences below this many seconds are noise, not regressions
+MIN_REGRESSION = 0.005
+
+TRIVIAL_SUITE = '''
+for i in range(int(NUM_TESTS)):
+    DefTest('true', 'true_%d' % i)
+'''
+
+MANY_SUITES = '''
+for s in range(int(NUM_TESTS) // 10):
+    DefSuite('suite_%d' % s)
+    for i in range(10):
+        DefTest('true', 'suite_%d_test_%d' % (s, i))
+'''
+
+LARGE_OUTPUT_SUITE = '''
+for i in range(int(NUM_TESTS)):
+    DefTest('head -c %s /dev/zero' % OUTPUT_SIZE, 'large_output_%d' % i)
+'''
+
+class NullLog(object):
+    """A log delegate that discards everything, to time the execution
+without the logging"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def reset():
+    del testrunner.ALL_TESTS[:]
+    testrunner.TESTS_BY_NAME.clear()
+    testrunner.SUITE_FIXTURES.clear()
+    testrunner.CURRENT_SUITE = 'default'
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+def expected_output(test):
+    if os.path.exists(test.stdout_name):
+        return test.stdout_name
+    return '/dev/null'
+
+def time_compare(tests):
+    """Times comparing the expected output of each test with a capture
+holding the same output, as when the tests pass"""
+    elapsed = 0.0
+    for test in tests:
+        capture = testrunner.OutputCapture()
+        with open(expected_output(test), 'rb') as f:
+            for chunk in iter(lambda: f.read(testrunner.COMPARE_CHUNK_SIZE), b''):
+                capture.write(chunk)
+
+        elapsed += timed(testrunner.diff, expected_output(test), capture,
+                         test.stdout_run_name)
+        capture.close()
+
+    return elapsed
+
+def time_log(tests, tmpdir):
+    log = testrunner.MultiDelegate()
+    log.delegates.append(testrunner.TextLog(os.path.join(tmpdir, 'bench.log')))
+    log.delegates.append(testrunner.XMLLog(os.path.join(tmpdir, 'bench.xml')))
+    log.delegates.append(testrunner.JSONLog(os.path.join(tmpdir, 'bench.jsonl')))
+
+    def replay():
+        current_suite = None
+        log.begin()
+        for test in tests:
+            if test.suite != current_suite:
+                log.start_suite(test.suite)
+                current_suite = test.suite
+            log.start_test(test)
+            log.end_test(test)
+        log.end(len(tests), 0)
+
+    return timed(replay)
+
+def run_scenario(name, testsuite_source, num_tests, jobs, tmpdir, defines=None):
+    """Runs all the phases on one generated testsuite, returns the time
+of each phase"""
+    testsuite = os.path.join(tmpdir, 'testsuite_%s' % name)
+    with open(testsuite, 'w') as f:
+        f.write(testsuite_source)
+
+    all_defines = {'NUM_TESTS': str(num_tests)}
+    all_defines.update(defines or {})
+
+    reset()
+    result = {'tests': num_tests}
+    result['load'] = timed(testrunner.execpyfile, testsuite, all_defines)
+    tests = list(testrunner.ALL_TESTS)
+
+    #Half exact names, half regexps, as generated from changed files
+    patterns = []
+    for i in range(NUM_PATTERNS):
+        test_name = tests[i * len(tests) // NUM_PATTERNS].name
+        if i % 2:
+            patterns.append('^%s$' % test_name)
+        else:
+            patterns.append('%s[a-z]*$' % test_name)
+    result['filter'] = timed(testrunner.filter_tests, patterns,
+                             lambda t: t.name)
+    testrunner.ALL_TESTS = list(tests)
+
+    result['execute'] = timed(testrunner.run_tests, NullLog(), jobs=jobs)
+    failed = [t for t in tests if t.errors]
+    if failed:
+        raise RuntimeError('%d tests failed in the %s benchmark, e.g. %s' %
+                           (len(failed), name, failed[0].errors))
+
+    command_time = sum([t.duration for t in tests]) / jobs
+    result['overhead_per_test'] = max(result['execute'] - command_time, 0) / num_tests
+    result['compare'] = time_compare(tests)
+    result['log'] = time_log(tests, tmpdir)
+    reset()
+    return result
+
+def run_benchmarks(sizes, jobs):
+    tmpdir = tempfile.mkdtemp()
+    results = {}
+    try:
+        with open(os.path.join(tmpdir, 'large_output_0.stdout'), 'wb') as f:
+            f.write(b'\0' * LARGE_OUTPUT_SIZE)
+        for i in range(1, LARGE_OUTPUT_TESTS):
+            shutil.copy(os.path.join(tmpdir, 'large_output_0.stdout'),
+                        os.path.join(tmpdir, 'large_output_%d.stdout' % i))
+
+        for size in sizes:
+            results['trivial_%d' % size] = run_scenario('trivial', TRIVIAL_SUITE,
+                                                        size, jobs, tmpdir)
+            results['many_suites_%d' % size] = run_scenario('many_suites',
+                                                            MANY_SUITES,
+                                                            size, jobs, tmpdir)
+        results['large_output'] = run_scenario('large_output',
+                                               LARGE_OUTPUT_SUITE,
+                                               LARGE_OUTPUT_TESTS, jobs, tmpdir,
+                                               {'OUTPUT_SIZE': str(LARGE_OUTPUT_SIZE)})
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+PHASES = ['load', 'filter', 'execute', 'compare', 'log']
+
+def report(results):
+    sys.stdout.write('%-20s %8s' % ('Benchmark', 'Tests'))
+    for phase in PHASES:
+        sys.stdout.write(' %10s' % phase)
+    sys.stdout.write(' %16s\n' % 'Overhead/test')
+
+    for name in sorted(results):
+        result = results[name]
+        sys.stdout.write('%-20s %8d' % (name, result['tests']))
+        for phase in PHASES:
+            sys.stdout.write(' %10.4f' % result[phase])
+        sys.stdout.write(' %11.1f usec\n' % (result['overhead_per_test'] * 10**6))
+
+def compare_baseline(results, baseline, tolerance):
+    """Returns the phases that are more than tolerance slower than in
+the baseline"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for phase in PHASES + ['overhead_per_test']:
+            old = baseline[name].get(phase)
+            new = results[name][phase]
+            if old is None:
+                continue
+            if phase == 'overhead_per_test':
+                slower = (new - old) * results[name]['tests']
+                change = '%.1f usec -> %.1f usec' % (old * 10**6, new * 10**6)
+            else:
+                slower = new - old
+                change = '%.4f sec. -> %.4f sec.' % (old, new)
+            if new > old * (1 + tolerance) and slower > MIN_REGRESSION:
+                regressions.append('%s %s: %s' % (name, phase, change))
+
+    return regressions
+
+def main():
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--sizes',
+                      action='store', dest='sizes', default=DEFAULT_SIZES,
+                      help='Comma separated number of tests in the generated ' +
+                           'testsuites. Default %s' % DEFAULT_SIZES)
+    parser.add_option('-j', '--jobs',
+                      action='store', dest='jobs', type='int', default=1,
+                      help='Number of tests to run in parallel')
+    parser.add_option('-o', '--output',
+                      action='store', dest='output',
+                      help='Save the results as JSON to OUTPUT')
+    parser.add_option('-b', '--baseline',
+                      action='store', dest='baseline',
+                      help='Compare the results with the JSON results in BASELINE')
+    parser.add_option('--tolerance',
+                      action='store', dest='tolerance', type='float', default=0.2,
+                      help='Fraction a phase can be slower than the baseline ' +
+                           'before it is a regression. Default 0.2')
+    (options, args) = parser.parse_args()
+
+    testrunner.CACHE_DIR = None
+    sizes = [int(size) for size in options.sizes.split(',')]
+    results = run_benchmarks(sizes, options.jobs)
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'python': sys.version, 'results': results}, f,
+                      indent=1, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare_baseline(results, baseline, options.tolerance)
+        if regressions:
+            sys.stdout.write('\nPerformance regressions:\n')
+            for regression in regressions:
+                sys.stdout.write('  %s\n' % regression)
+            return 1
+        sys.stdout.write('\nNo performance regressions\n')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Measures the time testrunner.py takes to load testsuite files that
+define many tests, to check that loading stays linear in the number of
+tests.
+
+Usage: bench_load.py [num_tests ...]
+"""
+import sys
+import os
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import testrunner
+
+DEFAULT_SIZES = [1000, 5000, 10000, 20000, 50000]
+
+#A testsuite that loops over a data set, like generated testsuites do
+TESTSUITE = '''
+for i in range(int(NUM_TESTS)):
+    DefTest('true', 'load_test_%d' % i)
+'''
+
+def reset():
+    del testrunner.ALL_TESTS[:]
+    testrunner.TESTS_BY_NAME.clear()
+
+def time_load(testsuite, num_tests):
+    reset()
+    start = time.time()
+    testrunner.execpyfile(testsuite, {'NUM_TESTS': str(num_tests)})
+    elapsed = time.time() - start
+    assert len(testrunner.ALL_TESTS) == num_tests
+    return elapsed
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    tmpdir = tempfile.mkdtemp()
+    try:
+        testsuite = os.path.join(tmpdir, 'testsuite_load')
+        with open(testsuite, 'w') as f:
+            f.write(TESTSUITE)
+
+        sys.stdout.write('%10s %12s %16s\n' % ('Tests', 'Load (sec)',
+                                              'Per test (usec)'))
+        per_test = []
+        for num_tests in sizes:
+            elapsed = time_load(testsuite, num_tests)
+            per_test.append(elapsed / num_tests)
+            sys.stdout.write('%10d %12.4f %16.2f\n' % (num_tests, elapsed,
+                                                      per_test[-1] * 10**6))
+    finally:
+        shutil.rmtree(tmpdir)
+        reset()
+
+    #With linear loading the cost per test stays about the same
+    growth = per_test[-1] / per_test[0]
+    sys.stdout.write('Per test load time growth from %d to %d tests: %.2fx\n' %
+                     (sizes[0], sizes[-1], growth))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
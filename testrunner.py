@@ -5,16 +5,85 @@ import subprocess
 import os
 import optparse
 import datetime
-import inspect
-import threading
+import difflib
+import select
+import tempfile
+import shutil
+import io
+import marshal
+import hashlib
+import json
+import shlex
+import cProfile
+import multiprocessing
+import collections
+import errno
+import signal
+import resource
+import fcntl
+import time
+import math
+import traceback
 from xml.sax.saxutils import XMLGenerator
 from xml.sax.xmlreader import AttributesImpl
+import xml.etree.ElementTree as ElementTree
 
 VERSION = '1.0.0'
 ALL_TESTS = []
+TESTS_BY_NAME = {}
+SUITE_FIXTURES = {}
 LOGFILE = None
 CURRENT_SUITE = 'default'
 DEFAULT_TEST_TIMEOUT = 30
+DIFF_FILES = False
+#Overwrite the existing baselines of benchmarks with -g, given by --rebaseline
+REBASELINE = False
+#Base directory of the run directories, given by --workdir
+WORKDIR = None
+#Directory holding the files written while running the tests in this run
+RUN_DIR = None
+#Locks RUN_DIR while the run lasts, so other runs do not remove it
+RUN_DIR_LOCK = None
+#File in a run directory naming the directory testrunner was run from
+RUN_DIR_OWNER = '.testrunner-cwd'
+COMPARE_CHUNK_SIZE = 64 * 1024
+MAX_DIFF_SIZE = 64 * 1024
+#Outputs larger than this are only diffed in a window at the first difference
+DIFF_INPUT_LIMIT = 1024 * 1024
+#The output of a failed test saved in the run directory is truncated after
+#this, unless the full output is needed for --diff-files
+SAVED_OUTPUT_LIMIT = 1024 * 1024
+DIFF_CONTEXT = 3
+CAPTURE_MEMORY_LIMIT = 4 * 1024 * 1024
+MAX_REAP_INTERVAL = 0.05
+#Seconds the output of a test may stay open after its command exited,
+#before the processes holding it open are killed
+OUTPUT_CLOSE_GRACE = 0.05
+#Interval between polls for the exit of benchmark runs
+PRECISE_REAP_INTERVAL = 0.00005
+#Budget for the memory weights of the tests running at the same time,
+#the physical memory by default
+MAX_MEMORY = None
+#No new tests are started while the load average is above MAX_LOAD or the
+#available memory is below MIN_FREE_MEMORY bytes
+MAX_LOAD = None
+MIN_FREE_MEMORY = None
+LOAD_CHECK_INTERVAL = 1.0
+#Seconds a timed out test gets to exit after SIGTERM before it's killed
+KILL_GRACE_PERIOD = 1.0
+#subprocess can start a new session without a preexec_fn from Python 3.2
+START_NEW_SESSION = sys.version_info >= (3, 2)
+CACHE_DIR = '.testrunner_cache'
+#Failure messages saved for --last-failed are cut to this many characters
+FAILURE_SUMMARY_SIZE = 1024
+SHA256_PATTERN = re.compile(r'^[0-9a-fA-F]{64}\Z')
+PROFILER = None
+WATCH_INTERVAL = 0.25
+#Benchmarks slower than the baseline by less than this many seconds pass,
+#below it the difference is within the resolution of the timing
+BENCHMARK_RESOLUTION = 0.001
+#time.monotonic() doesn't exist before Python 3.3
+monotonic = getattr(time, 'monotonic', time.time)
 #See README for detailed info
 
 #Start a new test suite
@@ -23,28 +92,101 @@ def DefSuite(suite):
     CURRENT_SUITE = suite
 
 #Define a test - to be called in the testsuite files
-def DefTest(cmd, name, success_codes=None, timeout=None):
+def DefTest(cmd, name, success_codes=None, timeout=None, deps=None,
+            shell=None, cpu_limit=None, memory_limit=None, files_limit=None,
+            slots=1, memory=0, exclusive=False, serial_group=None,
+            stdout=None, stderr=None, stdout_sha256=None, stderr_sha256=None):
+
+    for (stream, text, digest) in [('stdout', stdout, stdout_sha256),
+                                   ('stderr', stderr, stderr_sha256)]:
+        if text is not None and digest is not None:
+            raise ValueError('The test ''%s'' has both %s and %s_sha256' %
+                             (name, stream, stream))
+        if digest is not None and not SHA256_PATTERN.match(digest):
+            raise ValueError('The %s_sha256 of the test ''%s'' is not a '
+                             'SHA-256 hex digest' % (stream, name))
+
+    add_test(TestCase, cmd, name, success_codes, timeout, deps, shell,
+             limits=resource_limits(cpu_limit, memory_limit, files_limit),
+             slots=slots, memory=memory, exclusive=exclusive,
+             serial_group=serial_group,
+             stdout=stdout, stderr=stderr, stdout_sha256=stdout_sha256,
+             stderr_sha256=stderr_sha256)
+
+#Define a benchmark - a test where the run time of the command is compared
+#with a baseline. Benchmarks run alone by default, to not be slowed down
+#by other tests
+def DefBenchmark(cmd, name, repeat=10, warmup=1, tolerance=0.1,
+                 success_codes=None, timeout=None, deps=None, shell=None,
+                 cpu_limit=None, memory_limit=None, files_limit=None,
+                 slots=1, memory=0, exclusive=True, serial_group=None):
+
+    if repeat < 1:
+        raise ValueError('The benchmark ''%s'' must repeat at least once' % name)
+
+    add_test(BenchmarkCase, cmd, name, success_codes, timeout, deps, shell,
+             limits=resource_limits(cpu_limit, memory_limit, files_limit),
+             slots=slots, memory=memory, exclusive=exclusive,
+             serial_group=serial_group,
+             repeat=repeat, warmup=warmup, tolerance=tolerance)
+
+def resource_limits(cpu_limit, memory_limit, files_limit):
+    """The limits of a test as (resource, limit) pairs for setrlimit()"""
+    limits = []
+    for (rlimit, value) in [(resource.RLIMIT_CPU, cpu_limit),
+                            (resource.RLIMIT_AS, memory_limit),
+                            (resource.RLIMIT_NOFILE, files_limit)]:
+        if value is not None:
+            limits.append((rlimit, int(value)))
+    return limits
+
+def add_test(test_class, cmd, name, success_codes, timeout, deps, shell,
+             **options):
 
     if success_codes is None:
         success_codes = [0]
 
+    if deps is None:
+        deps = []
 
-    if name in set(t.name for t in ALL_TESTS):
+
+    if name in TESTS_BY_NAME:
         raise NameError('The test name ''%s'' is already defined' % name)
 
     if not timeout:
         timeout = int(DEFAULT_TEST_TIMEOUT)
 
-    #Figure out the file and line where the test is defined
-    frame = inspect.stack()[1]
-    cwd = os.path.dirname(inspect.getfile(frame[0])) or './'
-    test_location = {'cwd':      cwd,
-                     'filename': inspect.getfile(frame[0]),
-                     'lineno':   frame[0].f_lineno
+    #Figure out the file and line where the Def function is called
+    frame = sys._getframe(2)
+    filename = frame.f_code.co_filename
+    test_location = {'cwd':      os.path.dirname(filename) or './',
+                     'filename': filename,
+                     'lineno':   frame.f_lineno
                     }
 
-    t = TestCase(test_location, cmd, name, CURRENT_SUITE, success_codes, timeout)
+    t = test_class(test_location, cmd, name, CURRENT_SUITE, success_codes,
+                   timeout, deps, shell, **options)
     ALL_TESTS.append(t)
+    TESTS_BY_NAME[name] = t
+
+#Define setup and teardown commands for the current suite
+def DefFixture(setup, teardown=None, timeout=None):
+
+    if CURRENT_SUITE in SUITE_FIXTURES:
+        raise NameError('The suite ''%s'' already has a fixture' % CURRENT_SUITE)
+
+    if not timeout:
+        timeout = int(DEFAULT_TEST_TIMEOUT)
+
+    frame = sys._getframe(1)
+    filename = frame.f_code.co_filename
+    location = {'cwd':      os.path.dirname(filename) or './',
+                'filename': filename,
+                'lineno':   frame.f_lineno
+               }
+
+    SUITE_FIXTURES[CURRENT_SUITE] = Fixture(location, CURRENT_SUITE, setup,
+                                            teardown, timeout)
 
 class SimpleEnum(object):
 
@@ -54,6 +196,9 @@ class SimpleEnum(object):
     def __eq__(self, other):
         return self.__class__ == other.__class__
 
+    def __ne__(self, other):
+        return not self == other
+
     def __repr__(self):
         return str(self)
 
@@ -66,6 +211,8 @@ class TestResult(object):
         pass
     class NOTRUN(SimpleEnum):
         pass
+    class CACHED(SimpleEnum):
+        pass
 
 class TestFailure(object):
 
@@ -89,7 +236,14 @@ class MultiDelegate(object):
         def handler(*args, **kwargs):
             for d in self.delegates:
                 method = getattr(d, name)
+                start = monotonic()
                 method(*args, **kwargs)
+                if PROFILER:
+                    test = None
+                    if name in ('start_test', 'end_test'):
+                        test = args[0]
+                    PROFILER.add('log %s' % d.__class__.__name__,
+                                 monotonic() - start, test)
 
         return handler
 
@@ -129,7 +283,7 @@ class TerminalLog(object):
         self.out.flush()
 
     def end_test(self, test):
-        if test.result == TestResult.PASS():
+        if test.result in (TestResult.PASS(), TestResult.CACHED()):
             msg = self.maybe_color(str(test.result), self.GREEN)
         elif test.result == TestResult.NOTRUN():
            msg = str(test.result)
@@ -138,6 +292,12 @@ class TerminalLog(object):
 
         self.out.write('%s\n' % msg)
         if self.verbose:
+            if test.rusage:
+                self.out.write('    %.6f sec., %s\n' %
+                               (test.duration, format_resources(test.rusage)))
+            if test.benchmark:
+                self.out.write('    Benchmark: %s\n' %
+                               format_benchmark(test.benchmark))
             # might already shown the command
             if test.errors:
                 self.out.write('Failed command: %s\n' % test.cmd)
@@ -146,6 +306,12 @@ class TerminalLog(object):
 
         self.out.flush()
 
+    def slowest(self, tests):
+        self.out.write('\n## %d slowest tests:\n' % len(tests))
+        for test in tests:
+            self.out.write('  %-70s%.3f sec.\n' % (test.name, test.duration))
+        self.out.flush()
+
     def end(self, num_tests, num_failures):
         self.out.write('\n')
         if num_failures:
@@ -156,6 +322,9 @@ class TerminalLog(object):
                                          num_tests, self.GREEN))
         if LOGFILE:
             self.out.write('View complete log in the %s file.\n' % (LOGFILE))
+        if RUN_DIR and os.path.isdir(RUN_DIR):
+            self.out.write('The output of the failed tests is in the %s '
+                           'directory.\n' % RUN_DIR)
 
         self.out.flush()
 
@@ -181,8 +350,13 @@ class TextLog(object):
         self.out.write('## Command: %s\n' % test.cmd)
 
     def end_test(self, test):
-        duration = timedelta_total_seconds(test.end_time - test.start_time)
-        self.out.write('## Duration: %f sec.\n' % duration)
+        self.out.write('## Duration: %f sec.\n' % test.duration)
+        if test.rusage:
+            self.out.write('## Resources: %s\n' % format_resources(test.rusage))
+        if test.benchmark:
+            self.out.write('## Benchmark: %s\n' % format_benchmark(test.benchmark))
+        if test.profile:
+            self.out.write('## Profile: %s\n' % format_profile(test.profile))
         self.out.write('## Result: %s\n' % test.result)
 
         if test.errors:
@@ -192,6 +366,11 @@ class TextLog(object):
 
         self.out.flush()
 
+    def slowest(self, tests):
+        self.out.write('\n## %d slowest tests:\n' % len(tests))
+        for test in tests:
+            self.out.write('## %f sec. %s\n' % (test.duration, test.name))
+
     def end(self, num_tests, num_failures):
         self.out.write('\n')
         if num_failures:
@@ -235,12 +414,25 @@ class XMLLog(object):
         self.xml_doc.characters('\n')
 
     def end_test(self, test):
-        duration = timedelta_total_seconds(test.end_time - test.start_time)
         self.xml_doc.startElement('duration',AttributesImpl({}))
-        self.xml_doc.characters(str(duration))
+        self.xml_doc.characters(str(test.duration))
         self.xml_doc.endElement('duration')
         self.xml_doc.characters('\n')
 
+        if test.rusage:
+            attrs = AttributesImpl(dict((k, str(v)) for (k, v) in
+                                        test.rusage.items()))
+            self.xml_doc.startElement('resources', attrs)
+            self.xml_doc.endElement('resources')
+            self.xml_doc.characters('\n')
+
+        if test.benchmark:
+            attrs = AttributesImpl(dict((k, str(v)) for (k, v) in
+                                        test.benchmark.items()))
+            self.xml_doc.startElement('benchmark', attrs)
+            self.xml_doc.endElement('benchmark')
+            self.xml_doc.characters('\n')
+
         attrs = AttributesImpl({})
         self.xml_doc.startElement('result', attrs)
         self.xml_doc.characters(str(test.result))
@@ -261,6 +453,9 @@ class XMLLog(object):
         self.xml_doc.endElement('testcase')
         self.xml_doc.characters('\n')
 
+    def slowest(self, tests):
+        pass
+
     def end(self, num_tests, num_failures):
 
         if self.suite_started:
@@ -281,28 +476,132 @@ class XMLLog(object):
         self.xml_doc.endDocument()
         self.out.close()
 
+class JSONLog(object):
+    """Writes one JSON record per line, flushed as soon as each test ends"""
+
+    def __init__(self, logfile_name):
+        self.out = open(logfile_name, 'w')
+        self.logfile_name = logfile_name
+
+    def write(self, record):
+        self.out.write(json.dumps(record, sort_keys=True) + '\n')
+        self.out.flush()
+
+    def begin(self):
+        self.write({'type':       'begin',
+                    'time':       str(datetime.datetime.now()),
+                    'invocation': ' '.join(sys.argv)})
+
+    def start_suite(self, suite):
+        pass
+
+    def start_test(self, test):
+        pass
+
+    def end_test(self, test):
+        self.write({'type':      'test',
+                    'name':      test.name,
+                    'suite':     test.suite,
+                    'file':      test.filename,
+                    'line':      test.lineno,
+                    'command':   test.cmd,
+                    'result':    str(test.result),
+                    'duration':  test.duration,
+                    'exit_code': test.exitcode,
+                    'resources': test.rusage,
+                    'benchmark': test.benchmark,
+                    'errors':    [err.msg for err in test.errors],
+                    'profile':   test.profile or None})
+
+    def slowest(self, tests):
+        pass
+
+    def end(self, num_tests, num_failures):
+        if num_failures:
+            result = TestResult.FAIL()
+        else:
+            result = TestResult.PASS()
+
+        self.write({'type':     'end',
+                    'tests':    num_tests,
+                    'failures': num_failures,
+                    'result':   str(result)})
+        self.out.close()
+
 class TestCase(object):
 
-    def __init__(self, location, cmd,  name, suite, success_codes, timeout):
+    #Whether the exit of the command must be noticed without delay
+    precise_timing = False
+
+    def __init__(self, location, cmd,  name, suite, success_codes, timeout,
+                 deps=None, shell=None, limits=None, slots=1, memory=0,
+                 exclusive=False, serial_group=None, stdout=None, stderr=None,
+                 stdout_sha256=None, stderr_sha256=None):
         self.location      = location
         self.cmd           = cmd
         self.name          = name
         self.suite         = suite
         self.success_codes = success_codes
         self.timeout       = timeout
+        self.deps          = [os.path.join(self.cwd, d) for d in deps or []]
+        self.shell         = shell
+        self.limits        = limits or []
+        self.slots         = slots
+        self.memory        = memory
+        self.exclusive     = exclusive
+        self.serial_group  = serial_group
+        self._argv         = None
+        self.reset()
+
+        self.stdout_name = os.path.join(self.cwd,name + '.stdout')
+        self.stderr_name = os.path.join(self.cwd,name + '.stderr')
+        #The expected output given in DefTest(), None when it's in the file
+        self.expected_stdout = self.inline_output('stdout', stdout,
+                                                  stdout_sha256)
+        self.expected_stderr = self.inline_output('stderr', stderr,
+                                                  stderr_sha256)
+
+    def inline_output(self, stream, text, digest):
+        if text is not None:
+            return InlineOutput('%s= of %s' % (stream, self), text)
+        if digest is not None:
+            return OutputDigest('%s_sha256= of %s' % (stream, self), digest)
+        return None
+
+    def reset(self):
+        """Clear the result of an earlier run of the test"""
         self.result        = TestResult.NOTRUN()
         self.errors        = []
         self.start_time    = 0
         self.end_time      = 0
-
-        self.stdout_run_name = os.path.join(self.cwd,name + '.stdout-actual')
-        self.stderr_run_name = os.path.join(self.cwd,name + '.stderr-actual')
-
-        self.stdout_name = os.path.join(self.cwd,name + '.stdout')
-        self.stderr_name = os.path.join(self.cwd,name + '.stderr')
-
-        self.stdout_diff_name = os.path.join(self.cwd,name + '.stdout-diff')
-        self.stderr_diff_name = os.path.join(self.cwd,name + '.stderr-diff')
+        self.rusage        = None
+        self.exitcode      = None
+        self.changed_files = []
+        self.profile       = {}
+        self.benchmark     = None
+
+    def input_files(self):
+        """The files the result of the test depends on"""
+        files = []
+        if self.expected_stdout is None:
+            files.append(self.stdout_name)
+        if self.expected_stderr is None:
+            files.append(self.stderr_name)
+        return files + self.deps
+
+    def expected(self, inline, filename):
+        """The expected output of a stream, given in DefTest() or in
+filename. A missing file means no output is expected"""
+        if inline is not None:
+            return inline
+        if os.path.exists(filename):
+            return filename
+        return '/dev/null'
+
+    def settings(self):
+        """The parameters of the test that only some kinds of tests have,
+as text"""
+        return [repr(self.expected_stdout), repr(self.expected_stderr)]
 
     @property
     def cwd(self):
@@ -316,49 +615,112 @@ class TestCase(object):
     def lineno(self):
         return self.location['lineno']
 
+    def artifact_name(self, suffix):
+        """Name of a file written while running the test, in the run
+directory"""
+        return os.path.join(RUN_DIR or self.cwd, self.name + suffix)
+
+    @property
+    def stdout_run_name(self):
+        return self.artifact_name('.stdout-actual')
+
+    @property
+    def stderr_run_name(self):
+        return self.artifact_name('.stderr-actual')
+
+    @property
+    def stdout_diff_name(self):
+        return self.artifact_name('.stdout-diff')
+
+    @property
+    def stderr_diff_name(self):
+        return self.artifact_name('.stderr-diff')
+
     def __str__(self):
         return '%s at %s:%d' %(self.name,
                              self.filename,
                              self.lineno)
 
 
-    def run_test(self):
-        timedout = False
+    @property
+    def argv(self):
+        """The command to execute, a list of arguments when it's executed
+directly or the command string when it's executed by /bin/sh"""
+        if self._argv is None:
+            if self.shell is False:
+                self._argv = shlex.split(self.cmd)
+            elif self.shell is None and is_simple_command(self.cmd, self.cwd):
+                self._argv = self.cmd.split()
+            else:
+                self._argv = self.cmd
+
+        return self._argv
+
+    def spawn(self, supervisor, on_exit):
+        """Start the command. A simple command naming a file that is
+neither a program nor a #! script is run by /bin/sh instead, as the
+shell would run it as a shell script"""
+        try:
+            supervisor.spawn(self.argv, self.cwd, self.timeout, on_exit,
+                             limits=self.limits, precise=self.precise_timing)
+        except OSError as ex:
+            if (ex.errno != errno.ENOEXEC or self.shell is not None or
+                    not isinstance(self.argv, list)):
+                raise
+            self._argv = self.cmd
+            supervisor.spawn(self.argv, self.cwd, self.timeout, on_exit,
+                             limits=self.limits, precise=self.precise_timing)
+
+    def start(self, supervisor):
+        self.start_time = monotonic()
+        try:
+            self.spawn(supervisor, self.finish)
+            profile('spawn', self.start_time, self)
+        except OSError as ex:
+            self.end_time = monotonic()
+            self.result = TestResult.FAIL()
+            self.errors.append(TestFailure(self, 'Failed to execute: %s' % ex))
 
-        self.start_time = datetime.datetime.now()
-        (timedout, exitcode) = execute_program(self.stdout_run_name,
-                                               self.stderr_run_name,
-                                               self.cwd,
-                                               self.cmd,
-                                               self.timeout)
-        self.end_time = datetime.datetime.now()
+    def finish(self, child):
+        self.end_time = child.end_time
+        self.rusage = child.rusage
+        self.exitcode = child.exitcode
+        if PROFILER:
+            PROFILER.add('wait', child.end_time - child.spawned - child.read_time, self)
+            PROFILER.add('read', child.read_time, self)
 
         self.result = TestResult.PASS()
 
-        if timedout:
+        if child.timedout:
             self.result = TestResult.TIMEDOUT()
             self.errors.append(TestFailure(self,'Timed out after %d seconds' % self.timeout))
-            self.cleanup()
+            child.close()
             return
 
+        exitcode = child.exitcode
         if self.success_codes and exitcode not in self.success_codes:
             self.result = TestResult.FAIL()
             self.errors.append(TestFailure(self,
                           'Terminated with unexpected exit code %d' % exitcode))
 
         #Now diff the stdout and stderr output
-        stdout_name = self.stdout_name
-        if not os.path.exists(stdout_name):
-            stdout_name = '/dev/null'
-
-        stderr_name = self.stderr_name
-        if not os.path.exists(stderr_name):
-            stderr_name = '/dev/null'
-
-
-        stdout_diff = diff(stdout_name, self.stdout_run_name, self.stdout_diff_name)
-        stderr_diff = diff(stderr_name, self.stderr_run_name, self.stderr_diff_name)
-
+        start = monotonic()
+        stdout_name = self.expected(self.expected_stdout, self.stdout_name)
+        stderr_name = self.expected(self.expected_stderr, self.stderr_name)
+        stdout_diff = compare_output(stdout_name, child.stdout,
+                                     self.stdout_run_name)
+        stderr_diff = compare_output(stderr_name, child.stderr,
+                                     self.stderr_run_name)
+        profile('compare', start, self)
+
+        start = monotonic()
+        if stdout_diff:
+            save_failed_output(stdout_name, child.stdout,
+                               self.stdout_run_name, self.stdout_diff_name)
+        if stderr_diff:
+            save_failed_output(stderr_name, child.stderr,
+                               self.stderr_run_name, self.stderr_diff_name)
+        child.close()
 
         if stdout_diff:
             self.result = TestResult.FAIL()
@@ -367,126 +729,1745 @@ class TestCase(object):
         if stderr_diff:
             self.result = TestResult.FAIL()
             self.errors.append(TestFailure(self, stderr_diff))
+        profile('cleanup', start, self)
 
-        self.cleanup()
+    @property
+    def finished(self):
+        return self.result != TestResult.NOTRUN()
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def generates(self):
+        """Whether -g runs the test to write its output files"""
+        return True
+
+    def start_generate(self, supervisor):
+        self.start_time = monotonic()
+        try:
+            self.spawn(supervisor, self.save_output)
+        except OSError as ex:
+            self.end_time = monotonic()
+            self.result = TestResult.FAIL()
+            self.errors.append(TestFailure(self, str(ex)))
 
-    def generate(self):
-        execute_program(self.stdout_name,
-                        self.stderr_name,
-                        self.cwd,
-                        self.cmd,
-                        self.timeout)
+    def save_output(self, child):
+        """Writes the output files, files with unchanged output are left
+untouched. The files written or removed are added to changed_files"""
+        self.end_time = child.end_time
+        if child.timedout:
+            self.result = TestResult.TIMEDOUT()
+            self.errors.append(TestFailure(self,'Timed out after %d seconds' % self.timeout))
+            child.close()
+            return
 
-        if os.path.getsize(self.stdout_name) == 0:
-            silentremove(self.stdout_name)
-        if os.path.getsize(self.stderr_name) == 0:
-            silentremove(self.stderr_name)
+        self.result = TestResult.PASS()
+        for (capture, filename, expected) in (
+                (child.stdout, self.stdout_name, self.expected_stdout),
+                (child.stderr, self.stderr_name, self.expected_stderr)):
+            if expected is not None:
+                #Given in the testsuite file, which is not rewritten
+                continue
+            elif capture.size == 0:
+                if os.path.exists(filename):
+                    silentremove(filename)
+                    self.changed_files.append(filename)
+            elif not (os.path.exists(filename) and
+                      same_content(filename, capture)):
+                capture.save(filename)
+                self.changed_files.append(filename)
+        child.close()
 
     def cleanup(self):
-        silentremove(self.stdout_run_name)
-        silentremove(self.stderr_run_name)
-        silentremove(self.stdout_diff_name)
-        silentremove(self.stderr_diff_name)
-
-def execute_program(stdout_name, stderr_name, cwd, cmd, timeout):
-    with open(stdout_name, 'wb') as stdout:
-        with open(stderr_name, 'wb') as stderr:
-            process= subprocess.Popen(cmd,
-                    shell=True,
-                    stdout=stdout,
-                    stderr=stderr,
-                    cwd=cwd
-                    )
-            return wait_process(process, timeout)
-
-def wait_process(proc, timeout):
-    proc_thread = threading.Thread(target=proc.communicate)
-    proc_thread.daemon = True
-    proc_thread.start()
-    proc_thread.join(timeout=timeout)
-
-    if proc_thread.is_alive():
+        """Removes the files earlier versions wrote next to the
+testsuite file"""
+        for suffix in ('.stdout-actual', '.stderr-actual',
+                       '.stdout-diff', '.stderr-diff'):
+            silentremove(os.path.join(self.cwd, self.name + suffix))
+
+class BenchmarkCase(TestCase):
+    """A test that runs its command warmup times, and then repeat times
+where the wall and CPU time of each run is measured. The medians are
+compared with the baseline in the test_name.bench file, written by -g.
+The output of the command is not compared"""
+
+    precise_timing = True
+
+    def __init__(self, location, cmd, name, suite, success_codes, timeout,
+                 deps=None, shell=None, repeat=10, warmup=1, tolerance=0.1,
+                 **options):
+        TestCase.__init__(self, location, cmd, name, suite, success_codes,
+                          timeout, deps, shell, **options)
+        self.repeat        = repeat
+        self.warmup        = warmup
+        self.tolerance     = tolerance
+        self.baseline_name = os.path.join(self.cwd, name + '.bench')
+
+    def reset(self):
+        TestCase.reset(self)
+        self.num_runs = 0
+        self.runs     = []
+
+    def input_files(self):
+        return [self.baseline_name] + self.deps
+
+    def settings(self):
+        return [repr(self.repeat), repr(self.warmup), repr(self.tolerance)]
+
+    def start(self, supervisor):
+        self.start_time = monotonic()
+        self.run_next(supervisor, self.finish)
+
+    def generates(self):
+        #The baseline holds the times of the machine it was made on, so an
+        #existing one is only overwritten on request
+        return REBASELINE or not os.path.exists(self.baseline_name)
+
+    def start_generate(self, supervisor):
+        self.start_time = monotonic()
+        self.run_next(supervisor, self.save_output)
+
+    def run_next(self, supervisor, done):
+        def on_exit(child):
+            if self.measure(child):
+                child.close()
+                self.run_next(supervisor, done)
+            else:
+                done(child)
+
         try:
-            proc.kill()
-            return (True, -1)
+            self.spawn(supervisor, on_exit)
+        except OSError as ex:
+            self.end_time = monotonic()
+            self.result = TestResult.FAIL()
+            self.errors.append(TestFailure(self, 'Failed to execute: %s' % ex))
+
+    def measure(self, child):
+        """Records the times of a completed run, returns True if the
+command should run again"""
+        if child.timedout or not self.succeeded(child):
+            return False
+
+        self.num_runs += 1
+        if self.num_runs > self.warmup:
+            cpu = 0.0
+            if child.rusage:
+                cpu = child.rusage['user_time'] + child.rusage['system_time']
+            self.runs.append((child.end_time - child.started, cpu))
+
+        return self.num_runs < self.warmup + self.repeat
+
+    def succeeded(self, child):
+        return not self.success_codes or child.exitcode in self.success_codes
+
+    def check_run(self, child):
+        """Fails the test if the last run timed out or failed"""
+        self.end_time = child.end_time
+        self.rusage = child.rusage
+        self.exitcode = child.exitcode
+        child.close()
+        if child.timedout:
+            self.result = TestResult.TIMEDOUT()
+            self.errors.append(TestFailure(self,'Timed out after %d seconds' % self.timeout))
+        elif not self.succeeded(child):
+            self.result = TestResult.FAIL()
+            self.errors.append(TestFailure(self,
+                          'Terminated with unexpected exit code %d' % child.exitcode))
+        else:
+            self.result = TestResult.PASS()
+            self.benchmark = benchmark_statistics(self.runs)
+
+        return self.result == TestResult.PASS()
+
+    def finish(self, child):
+        if not self.check_run(child):
+            return
 
+        baseline = read_json(self.baseline_name, None)
+        if baseline:
+            for regression in benchmark_regressions(self.benchmark, baseline,
+                                                    self.tolerance):
+                self.result = TestResult.FAIL()
+                self.errors.append(TestFailure(self, regression))
+
+    def save_output(self, child):
+        if self.check_run(child):
+            write_json(self.baseline_name, self.benchmark)
+            self.changed_files.append(self.baseline_name)
+
+class Fixture(object):
+    """The setup and teardown commands of a suite. The TestExecutor runs
+the setup command before the first test of the suite is started, and the
+teardown command once all the tests of the suite have completed.
+
+state is None until the setup command is started, then 'setup',
+'ready' or 'failed', and 'teardown' and 'done' for the teardown"""
+
+    #The fixture commands are scheduled as a test with the default weight
+    slots        = 1
+    memory       = 0
+    exclusive    = False
+    serial_group = None
+
+    def __init__(self, location, suite, setup, teardown, timeout):
+        self.location       = location
+        self.suite          = suite
+        self.setup          = setup
+        self.teardown       = teardown
+        self.timeout        = timeout
+        self.state          = None
+        self.running        = False
+        self.error          = None
+        self.teardown_error = None
+
+    @property
+    def cwd(self):
+        return self.location['cwd']
+
+    @property
+    def finished(self):
+        return not self.running
+
+    def start_setup(self, supervisor):
+        self.state = 'setup'
+        self.start(supervisor, self.setup, self.setup_done)
+
+    def start_teardown(self, supervisor):
+        self.state = 'teardown'
+        if self.teardown:
+            self.start(supervisor, self.teardown, self.teardown_done)
+        else:
+            self.teardown_done(None)
+
+    def start(self, supervisor, cmd, done):
+        self.running = True
+        def on_exit(child):
+            done(self.command_error(cmd, child))
+        try:
+            #Commands like starting a server in the background leave
+            #processes running for the tests
+            supervisor.spawn(cmd, self.cwd, self.timeout, on_exit,
+                             keep_group=True)
+        except OSError as ex:
+            done('Failed to execute: %s' % ex)
+
+    def setup_done(self, error):
+        self.running = False
+        self.error = error
+        if error:
+            self.state = 'failed'
+        else:
+            self.state = 'ready'
+
+    def teardown_done(self, error):
+        self.running = False
+        self.teardown_error = error
+        self.state = 'done'
+
+    def command_error(self, cmd, child):
+        """Describes why a fixture command failed, with its output, or
+returns None if it succeeded"""
+        if child.timedout:
+            error = 'Timed out after %d seconds' % self.timeout
+        elif child.exitcode != 0:
+            error = 'Terminated with unexpected exit code %d' % child.exitcode
+        else:
+            child.close()
+            return None
+
+        error = 'Command: %s\n%s' % (cmd, error)
+        for (name, capture) in (('stdout', child.stdout),
+                                ('stderr', child.stderr)):
+            if capture.size:
+                output = capture.read(0, MAX_DIFF_SIZE)
+                error += '\n%s:\n%s' % (name, output.decode('utf-8', 'replace'))
+        child.close()
+        return error
+
+class LoggedError(object):
+    """A test failure read back from a log file"""
+
+    def __init__(self, text):
+        self.text = text
+        self.msg = text
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return str(self)
+
+class LoggedTest(object):
+    """A test result read back from a log file, with the attributes the
+log delegates use from a TestCase"""
+
+    def __init__(self, name, suite):
+        self.name      = name
+        self.suite     = suite
+        self.cmd       = ''
+        self.filename  = ''
+        self.lineno    = 0
+        self.result    = TestResult.NOTRUN()
+        self.duration  = 0.0
+        self.rusage    = None
+        self.exitcode  = None
+        self.errors    = []
+        self.profile   = {}
+        self.benchmark = None
+
+    def __str__(self):
+        if self.filename:
+            return '%s at %s:%d' % (self.name, self.filename, self.lineno)
+        return self.name
+
+class OutputCapture(object):
+    """Collects the output of a test command in memory. Once the output
+grows beyond CAPTURE_MEMORY_LIMIT bytes it is moved to a temporary file"""
+
+    def __init__(self):
+        self.out = io.BytesIO()
+        self.size = 0
+        self.spilled = False
+
+    def write(self, data):
+        if not self.spilled and self.size + len(data) > CAPTURE_MEMORY_LIMIT:
+            spill = tempfile.TemporaryFile()
+            spill.write(self.out.getvalue())
+            self.out = spill
+            self.spilled = True
+
+        self.out.write(data)
+        self.size += len(data)
+
+    def chunks(self):
+        self.out.seek(0)
+        while True:
+            chunk = self.out.read(COMPARE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, offset, size):
+        self.out.seek(offset)
+        return self.out.read(size)
+
+    def save(self, filename, limit=None):
+        """Writes the captured output to filename, at most limit bytes"""
+        with open(filename, 'wb') as f:
+            for chunk in self.chunks():
+                if limit is not None:
+                    chunk = chunk[:limit - f.tell()]
+                    if not chunk:
+                        break
+                f.write(chunk)
+
+    def close(self):
+        self.out.close()
+
+SHELL_SPECIAL_CHARS = set('|&;<>()$`\\"\' \t\n*?[]#~{}!')
+#Builtins that don't exist as executables, or where the executable
+#behaves differently from the /bin/sh builtin
+SHELL_BUILTINS = set(['.', ':', '[', 'alias', 'bg', 'break', 'cd', 'command',
+                      'continue', 'echo', 'eval', 'exec', 'exit', 'export',
+                      'fc', 'fg', 'getopts', 'hash', 'jobs', 'kill', 'printf',
+                      'pwd', 'read', 'readonly', 'return', 'set', 'shift',
+                      'source', 'test', 'times', 'trap', 'type', 'ulimit',
+                      'umask', 'unalias', 'unset', 'wait'])
+EXECUTABLES = {}
+
+def find_executable(program, cwd):
+    """Check if program can be executed directly, from cwd or the PATH"""
+    key = (program, cwd)
+    if key not in EXECUTABLES:
+        if '/' in program:
+            paths = [os.path.join(cwd, program)]
+        else:
+            paths = [os.path.join(d, program) for d in
+                     os.environ.get('PATH', os.defpath).split(os.pathsep)]
+        EXECUTABLES[key] = False
+        for path in paths:
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                EXECUTABLES[key] = True
+                break
+
+    return EXECUTABLES[key]
+
+def is_simple_command(cmd, cwd):
+    """Check if the command can be executed without /bin/sh, that is
+the command is just a program and arguments with nothing for the
+shell to expand"""
+    args = cmd.split()
+    if not args or args[0] in SHELL_BUILTINS or '=' in args[0]:
+        #'=' is a variable assignment in the first word
+        return False
+
+    for arg in args:
+        if SHELL_SPECIAL_CHARS.intersection(arg):
+            return False
+
+    #Let /bin/sh report programs that are not found, as usual
+    return find_executable(args[0], cwd)
+
+def start_session(limits):
+    """Runs in the child process before the command is executed"""
+    os.setsid()
+    for (rlimit, value) in limits:
+        (soft, hard) = resource.getrlimit(rlimit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(rlimit, (value, hard))
+
+class Child(object):
+    """A command run by the Supervisor. The stdout and stderr output
+is collected in OutputCapture buffers. cmd is run by /bin/sh unless it's
+a list of arguments.
+
+The command runs in a new session, so the command and any processes
+it starts can be killed together. limits are (resource, limit) pairs
+set with setrlimit() for the command.
+
+The command is done when it exits and its output is closed. Processes
+it started in the background that hold the output open for more than
+OUTPUT_CLOSE_GRACE seconds after it exited are killed, unless keep_group
+is set.
+
+The exit is noticed through a pidfd where the platform has them, and
+is polled for with a growing interval otherwise. With precise the exit
+is polled for without backoff once the output is closed, so the run time
+from started to end_time is accurate"""
+
+    def __init__(self, cmd, cwd, timeout, on_exit, keep_group=False,
+                 limits=None, precise=False):
+        self.stdout = OutputCapture()
+        self.stderr = OutputCapture()
+        options = {}
+        if limits:
+            options['preexec_fn'] = lambda: start_session(limits)
+        elif START_NEW_SESSION:
+            options['start_new_session'] = True
+        else:
+            options['preexec_fn'] = os.setsid
+        self.started = monotonic()
+        self.proc = subprocess.Popen(cmd,
+                                     shell=not isinstance(cmd, list),
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     cwd=cwd,
+                                     **options
+                                     )
+        self.spawned = monotonic()
+        self.read_time = 0.0
+        self.deadline = self.spawned + timeout
+        self.on_exit = on_exit
+        self.outputs = {self.proc.stdout.fileno(): (self.proc.stdout, self.stdout),
+                        self.proc.stderr.fileno(): (self.proc.stderr, self.stderr)}
+        self.keep_group = keep_group
+        self.precise = precise
+        self.reap_interval = 0.0005
+        self.next_reap = self.spawned + self.reap_interval
+        #Readable once the command exits, os.pidfd_open() is in Python 3.9
+        #and Linux 5.3 and later
+        self.pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                self.pidfd = os.pidfd_open(self.proc.pid)
+                self.next_reap = float('inf')
+            except OSError:
+                pass
+        self.timedout = False
+        self.exitcode = None
+        self.output_deadline = None
+        self.end_time = None
+        self.rusage = None
+
+    def read(self, fd):
+        if fd == self.pidfd:
+            self.next_reap = monotonic()
+            return
+
+        start = monotonic()
+        (pipe, capture) = self.outputs[fd]
+        data = os.read(fd, COMPARE_CHUNK_SIZE)
+        if data:
+            capture.write(data)
+        else:
+            pipe.close()
+            del self.outputs[fd]
+            if not self.outputs:
+                #The command is most likely exiting, poll for it quickly
+                self.reap_interval = 0.0005
+                self.next_reap = monotonic()
+        self.read_time += monotonic() - start
+
+    def exited(self, now):
+        """Check if the command has exited, polling for it with a
+growing interval up to MAX_REAP_INTERVAL"""
+        if now < self.next_reap:
+            return False
+        if self.reap():
+            return True
+        if self.pidfd is not None:
+            self.next_reap = float('inf')
+            return False
+        if self.precise and not self.outputs:
+            #The command is exiting, poll again shortly without backoff.
+            #Sleeping rather than spinning leaves the CPU to the command
+            self.next_reap = now + PRECISE_REAP_INTERVAL
+            return False
+        self.reap_interval = min(self.reap_interval * 2, MAX_REAP_INTERVAL)
+        self.next_reap = now + self.reap_interval
+        return False
+
+    def reap(self, options=os.WNOHANG):
+        """Check if the process has exited and collect its exit code and
+resource usage, returns True if it has"""
+        try:
+            (pid, status, rusage) = os.wait4(self.proc.pid, options)
+        except OSError as ex:
+            if ex.errno == errno.EINTR:
+                return False
+            if ex.errno != errno.ECHILD or self.proc.returncode is None:
+                raise
+            #Already reaped by Popen, the resource usage is lost
+            self.end_time = monotonic()
+            self.close_pidfd()
+            self.exitcode = self.proc.returncode
+            return True
+
+        if pid == 0:
+            return False
+
+        self.end_time = monotonic()
+        self.close_pidfd()
+        if os.WIFSIGNALED(status):
+            self.exitcode = -os.WTERMSIG(status)
+        else:
+            self.exitcode = os.WEXITSTATUS(status)
+        #Let Popen know the process is reaped
+        self.proc.returncode = self.exitcode
+        self.rusage = resource_usage(rusage)
+        return True
+
+    def signal_group(self, sig):
+        """Send sig to the command and all the processes it started"""
+        try:
+            os.killpg(self.proc.pid, sig)
         except OSError:
-            #This takes care of most of the races between
-            #is_alive and kill. Though they don't matter much
-            #for our cases where the timeout should just be a guard
+            #All of them exited after the timeout was detected
             pass
 
-    return (False, proc.returncode)
+    def terminate(self):
+        """Ask the command to exit, it's killed if it hasn't exited
+within KILL_GRACE_PERIOD seconds"""
+        self.timedout = True
+        self.deadline = monotonic() + KILL_GRACE_PERIOD
+        self.signal_group(signal.SIGTERM)
+
+    def kill(self):
+        self.timedout = True
+        self.signal_group(signal.SIGKILL)
 
-def diff(orig, new, out):
-    cmd = ['diff', '-u', orig, new]
-    with open(out, 'w') as stdout:
-        exitcode = subprocess.call(cmd, stdout=stdout, stderr=stdout)
+        #Grandchildren may still hold the pipes open, stop reading them
+        self.close_outputs()
+        while not self.reap(0):
+            pass
+        self.exitcode = -1
+
+    def drain(self):
+        """Read the output that is ready and stop reading the pipes"""
+        while self.outputs:
+            fds = wait_readable(list(self.outputs.keys()), 0)
+            if not fds:
+                break
+            for fd in fds:
+                self.read(fd)
+        self.close_outputs()
+
+    def close_pidfd(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+    def close_outputs(self):
+        for (pipe, capture) in self.outputs.values():
+            pipe.close()
+        self.outputs = {}
+
+    def close(self):
+        self.stdout.close()
+        self.stderr.close()
+
+class Supervisor(object):
+    """Runs commands and watches the output, exit and timeout of all of
+them from a single loop"""
+
+    def __init__(self):
+        self.children = []
+
+    def spawn(self, cmd, cwd, timeout, on_exit, keep_group=False,
+              limits=None, precise=False):
+        """Start cmd, on_exit is called with the Child once the command
+exits or times out. With keep_group the processes cmd leaves running
+are not killed"""
+        child = Child(cmd, cwd, timeout, on_exit, keep_group, limits,
+                      precise)
+        self.children.append(child)
+        return child
+
+    def poll(self):
+        """Wait for output, exits and timeouts of the children and handle
+them. on_exit of the completed children are called"""
+        if not self.children:
+            return
+
+        now = monotonic()
+        readers = {}
+        timeout = None
+        for child in self.children:
+            for fd in child.outputs:
+                readers[fd] = child
+            if child.pidfd is not None:
+                readers[child.pidfd] = child
+
+            if child.exitcode is None:
+                wait = min(child.deadline, child.next_reap) - now
+            else:
+                wait = child.output_deadline - now
+            if timeout is None or wait < timeout:
+                timeout = wait
+
+        if timeout is not None:
+            timeout = max(timeout, 0)
+
+        for fd in wait_readable(list(readers.keys()), timeout):
+            readers[fd].read(fd)
+
+        now = monotonic()
+        for child in list(self.children):
+            if child.exitcode is None:
+                if not child.exited(now):
+                    if now < child.deadline:
+                        continue
+                    if not child.timedout:
+                        child.terminate()
+                        continue
+                    child.kill()
+                elif child.timedout:
+                    #Exited after SIGTERM, kill what's left of the group
+                    child.signal_group(signal.SIGKILL)
+                else:
+                    child.output_deadline = now + OUTPUT_CLOSE_GRACE
+
+            if child.outputs and not child.timedout and not child.keep_group:
+                #Read up to the end of the output, unless processes the
+                #command started in the background hold it open
+                if now < child.output_deadline:
+                    continue
+                child.signal_group(signal.SIGKILL)
+
+            child.drain()
+            self.children.remove(child)
+            child.on_exit(child)
+
+    def run(self):
+        while self.children:
+            self.poll()
+
+    def kill_all(self):
+        for child in self.children:
+            child.kill()
+            child.close()
+        self.children = []
+
+def total_memory():
+    """The physical memory in bytes, or None if it's unknown"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def available_memory():
+    """The memory in bytes available for starting new processes without
+swapping, or None if it's unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def resource_usage(rusage):
+    """The resources used by a test, from the rusage of the reaped process"""
+    max_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        max_rss //= 1024 #bytes rather than kB
+
+    return {'user_time':      rusage.ru_utime,
+            'system_time':    rusage.ru_stime,
+            'max_rss':        max_rss,
+            'blocks_in':      rusage.ru_inblock,
+            'blocks_out':     rusage.ru_oublock,
+            'voluntary_ctx':  rusage.ru_nvcsw,
+            'involuntary_ctx':rusage.ru_nivcsw}
+
+def format_resources(usage):
+    return ('CPU user %.6f sec., system %.6f sec., max RSS %d kB, ' +
+            'blocks in %d, out %d, context switches %d/%d') % (
+                usage['user_time'], usage['system_time'], usage['max_rss'],
+                usage['blocks_in'], usage['blocks_out'],
+                usage['voluntary_ctx'], usage['involuntary_ctx'])
+
+def percentile(values, fraction):
+    """The nearest rank percentile of the sorted values"""
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+def median(values):
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def benchmark_statistics(runs):
+    """The min, median and 95th percentile of the wall and CPU times of
+the runs, a list of (wall time, CPU time)"""
+    stats = {'runs': len(runs)}
+    for (i, kind) in enumerate(['wall', 'cpu']):
+        values = sorted([run[i] for run in runs])
+        stats[kind + '_min'] = values[0]
+        stats[kind + '_median'] = median(values)
+        stats[kind + '_p95'] = percentile(values, 0.95)
+
+    return stats
+
+def benchmark_regressions(stats, baseline, tolerance):
+    """Describes the median times that are more than tolerance slower
+than in the baseline"""
+    regressions = []
+    for (kind, label) in [('wall', 'wall'), ('cpu', 'CPU')]:
+        old = baseline.get(kind + '_median')
+        new = stats[kind + '_median']
+        if old is None:
+            continue
+        if new > old * (1 + tolerance) and new - old > BENCHMARK_RESOLUTION:
+            regressions.append('Median %s time %.6f sec. is slower than the '
+                               'baseline %.6f sec. by more than %d%%' %
+                               (label, new, old, tolerance * 100))
+
+    return regressions
+
+def format_benchmark(stats):
+    return ('wall min %.6f median %.6f p95 %.6f sec., ' +
+            'CPU min %.6f median %.6f p95 %.6f sec., %d runs') % (
+                stats['wall_min'], stats['wall_median'], stats['wall_p95'],
+                stats['cpu_min'], stats['cpu_median'], stats['cpu_p95'],
+                stats['runs'])
+
+def wait_readable(fds, timeout):
+    """Wait up to timeout seconds for any of the fds to become readable,
+returns the readable fds"""
+    try:
+        #poll() waits in milliseconds, shorter waits need select(), which
+        #only takes fds below FD_SETSIZE
+        if hasattr(select, 'poll') and (timeout is None or timeout >= 0.001 or
+                                        [fd for fd in fds if fd >= 1024]):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLPRI |
+                                    select.POLLHUP | select.POLLERR)
+            if timeout is not None:
+                timeout = timeout * 1000
+            return [fd for (fd, event) in poller.poll(timeout)]
+
+        return select.select(fds, [], [], timeout)[0]
+    except (select.error, OSError) as ex:
+        if ex.args[0] != errno.EINTR:
+            raise
+        return []
+
+class InlineOutput(object):
+    """Expected output given as text in DefTest() instead of in a file.
+It's compared with the captured output in memory, and can be used in
+place of a filename in diff()"""
+
+    def __init__(self, name, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        self.name = name
+        self.data = text
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'InlineOutput(%r)' % self.data
+
+class OutputDigest(object):
+    """Expected output given as its SHA-256 digest in DefTest(). The
+captured output is hashed a chunk at a time, there is nothing to diff"""
+
+    def __init__(self, name, digest):
+        self.name = name
+        self.digest = digest.lower()
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'OutputDigest(%r)' % self.digest
+
+def output_size(orig):
+    if isinstance(orig, InlineOutput):
+        return len(orig.data)
+    return os.path.getsize(orig)
+
+def open_output(orig):
+    """Opens the orig file, or the text of an InlineOutput, for reading"""
+    if isinstance(orig, InlineOutput):
+        return io.BytesIO(orig.data)
+    return open(orig, 'rb')
+
+def compare_output(orig, capture, label):
+    """Returns a description of how the captured output differs from
+the expected output orig, or an empty string if it's as expected"""
+    if not isinstance(orig, OutputDigest):
+        return diff(orig, capture, label)
+
+    h = hashlib.sha256()
+    for chunk in capture.chunks():
+        h.update(chunk)
+    if h.hexdigest() == orig.digest:
+        return ''
+    return ('SHA-256 of the output is %s, expected %s from %s\n' %
+            (h.hexdigest(), orig.digest, orig))
+
+def same_content(orig, capture):
+    """Check if the content of the orig file equals the captured output,
+comparing them a chunk at a time"""
+    if output_size(orig) != capture.size:
+        return False
+
+    with open_output(orig) as orig_file:
+        for chunk in capture.chunks():
+            if orig_file.read(len(chunk)) != chunk:
+                return False
+
+    return True
+
+def common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i:i + 1] != b[i:i + 1]:
+            return i
+    return length
+
+def track_lines(data, offset, line_starts):
+    """Adds the offsets where the last lines in data starts to
+line_starts, returns the number of lines in data"""
+    found = []
+    end = len(data)
+    while len(found) < line_starts.maxlen:
+        end = data.rfind(b'\n', 0, end)
+        if end < 0:
+            break
+        found.append(offset + end + 1)
+    line_starts.extend(reversed(found))
+    return data.count(b'\n')
+
+def first_difference(orig, capture):
+    """Finds the first difference between the orig file and the captured
+output, reading a chunk at a time. Returns the byte offset and line
+number of the difference, 0 based, and the offsets where the lines up
+to DIFF_CONTEXT lines before it starts"""
+    offset = 0
+    line = 0
+    line_starts = collections.deque([0], DIFF_CONTEXT + 1)
+    with open_output(orig) as orig_file:
+        for chunk in capture.chunks():
+            orig_chunk = orig_file.read(len(chunk))
+            if orig_chunk != chunk:
+                common = common_prefix_length(orig_chunk, chunk)
+                line += track_lines(chunk[:common], offset, line_starts)
+                return (offset + common, line, list(line_starts))
+
+            line += track_lines(chunk, offset, line_starts)
+            offset += len(chunk)
+
+    return (offset, line, list(line_starts))
+
+def read_window(filename, capture, offset, size):
+    """Reads up to size bytes of the lines from offset in the file, or the
+capture if filename is None. A last partial line is left out"""
+    if filename is None:
+        data = capture.read(offset, size)
+        at_end = offset + len(data) >= capture.size
+    else:
+        with open_output(filename) as f:
+            f.seek(offset)
+            data = f.read(size)
+        at_end = offset + len(data) >= output_size(filename)
+
+    lines = data.splitlines(True)
+    if not at_end and len(lines) > 1 and not lines[-1].endswith(b'\n'):
+        lines.pop()
+    return [l.decode('utf-8', 'replace') for l in lines]
+
+def format_range(start, stop):
+    """Line range of a hunk in the unified diff format, start is 0 based"""
+    length = stop - start
+    if length == 1:
+        return '%d' % (start + 1)
+    if not length:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, length)
+
+def unified_diff(a, b, a_name, b_name, first_line=0):
+    """Yields the lines of a unified diff between the lines in a and b,
+which both starts at line first_line"""
+    yield '--- %s\n' % a_name
+    yield '+++ %s\n' % b_name
+    matcher = difflib.SequenceMatcher(None, a, b)
+    for group in matcher.get_grouped_opcodes(DIFF_CONTEXT):
+        yield '@@ -%s +%s @@\n' % (
+            format_range(first_line + group[0][1], first_line + group[-1][2]),
+            format_range(first_line + group[0][3], first_line + group[-1][4]))
+        for (tag, i1, i2, j1, j2) in group:
+            if tag == 'equal':
+                lines = [' ' + l for l in a[i1:i2]]
+            else:
+                lines = ['-' + l for l in a[i1:i2]] + ['+' + l for l in b[j1:j2]]
+            for line in lines:
+                if not line.endswith('\n'):
+                    line += '\n\\ No newline at end of file\n'
+                yield line
+
+def diff(orig, capture, label):
+    """Returns the differences between the orig file and the captured
+output in the unified diff format, or an empty string if they are equal.
+label names the captured output in the diff.
+
+Large outputs are only diffed in a window from the first difference,
+and the diff is truncated after MAX_DIFF_SIZE bytes. Then the diff
+starts with the location of the first difference"""
+    if same_content(orig, capture):
+        return ''
+
+    (offset, line, line_starts) = first_difference(orig, capture)
+    orig_size = output_size(orig)
+    partial = orig_size + capture.size > DIFF_INPUT_LIMIT
+    if partial:
+        window = max(MAX_DIFF_SIZE, COMPARE_CHUNK_SIZE)
+        first_line = line - len(line_starts) + 1
+        a = read_window(orig, None, line_starts[0], window)
+        b = read_window(None, capture, line_starts[0], window)
+    else:
+        first_line = 0
+        a = read_window(orig, None, 0, orig_size)
+        b = read_window(None, capture, 0, capture.size)
+
+    result = []
+    size = 0
+    for diff_line in unified_diff(a, b, orig, label, first_line):
+        if size + len(diff_line) > MAX_DIFF_SIZE:
+            partial = True
+            result.append('... diff truncated after %d bytes\n' % size)
+            break
+        result.append(diff_line)
+        size += len(diff_line)
+
+    if partial:
+        result.insert(0, 'Output differs from %s at byte offset %d, line %d\n' %
+                         (orig, offset, line + 1))
+
+    return ''.join(result)
+
+def save_failed_output(orig, capture, actual_name, diff_name):
+    """Saves the captured output of a failed test in the run directory,
+and with --diff-files the full unified diff against the orig file. Only
+the digest of the output is checked against an OutputDigest, so the
+output is not saved then"""
+    if RUN_DIR is None or isinstance(orig, OutputDigest):
+        return
+
+    if not DIFF_FILES:
+        capture.save(actual_name, SAVED_OUTPUT_LIMIT)
+        return
+
+    capture.save(actual_name)
+
+    with open(diff_name, 'w') as out:
+        if isinstance(orig, InlineOutput):
+            #The expected output is given to diff on stdin
+            cmd = ['diff', '-u', '-', actual_name]
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out,
+                                    stderr=out)
+            proc.communicate(orig.data)
+            exitcode = proc.returncode
+        else:
+            cmd = ['diff', '-u', orig, actual_name]
+            exitcode = subprocess.call(cmd, stdout=out, stderr=out)
         if exitcode not in [0, 1]: #diff itself failed
             raise RuntimeError('Failed(exitcode=%d: %s ' %
                             (exitcode, str(cmd)))
-    with open(out, 'r') as diff_result:
-        return diff_result.read()
 
-def run_tests(log, verbose=False, errexit=False):
+class TestExecutor(object):
+    """Runs up to jobs tests at a time under a single Supervisor.
+
+The tests are started in definition order, wait() runs the tests until
+a given test has completed so the results can be reported in
+definition order regardless of the order the tests finished in.
+
+The tests of a suite with a Fixture are held back until its setup
+command has passed, and the teardown command is run when the last of
+them completes. A failed teardown fails the last test of the suite.
+
+The tests running at the same time can use up to jobs slots and
+MAX_MEMORY bytes of memory, as given by the weights of the tests. An
+exclusive test runs alone, and only one test of a serial group runs at a
+time. The tests are started in order, a test that does not fit holds
+back the tests after it until enough of the running tests complete. No
+tests are started while the machine is overloaded, see MAX_LOAD and
+MIN_FREE_MEMORY. A test is always started when nothing else runs, so
+heavy tests and load from elsewhere can not stop the run."""
+
+    def __init__(self, jobs, errexit=False, result_cache=None, history=None,
+                 generate=False, first=None):
+        self.jobs = jobs
+        #Names of the tests to start ahead of the others
+        self.first = first
+        self.errexit = errexit
+        self.generate = generate
+        self.result_cache = result_cache
+        self.history = history
+        self.supervisor = Supervisor()
+        self.pending = collections.deque()
+        self.running = []
+        self.cancelled = False
+        self.fixtures = {}
+        #Number of tests left to complete in each suite with a fixture
+        self.remaining = {}
+        self.last_test = {}
+        #Tests held back until the setup of their suite completes
+        self.waiting = {}
+        #The running test of each serial group, and the tests waiting for it
+        self.group_running = {}
+        self.group_waiting = {}
+        self.max_memory = MAX_MEMORY or total_memory()
+        self.load_checked = None
+        self.overloaded = False
+
+    def start(self, tests):
+        for test in tests:
+            if test.suite in SUITE_FIXTURES:
+                self.fixtures[test.suite] = SUITE_FIXTURES[test.suite]
+                self.remaining[test.suite] = self.remaining.get(test.suite, 0) + 1
+                self.last_test[test.suite] = test
+
+        if self.jobs > 1 and self.history:
+            #Results are reported in definition order anyway, so start the
+            #longest tests first to not have them stretch out the run.
+            tests = self.history.longest_first(tests)
+        if self.first:
+            tests = sorted(tests, key=lambda t: t.name not in self.first)
+        self.pending.extend(tests)
+
+    def schedule(self):
+        finished = [t for t in self.running if t.finished]
+        self.running = [t for t in self.running if not t.finished]
+        for item in finished:
+            if isinstance(item, Fixture):
+                self.fixture_done(item)
+            else:
+                self.test_done(item)
+
+        while not self.cancelled and self.pending:
+            test = self.pending[0]
+            if self.result_cache and self.result_cache.passed(test):
+                self.pending.popleft()
+                test.start_time = test.end_time = monotonic()
+                test.result = TestResult.CACHED()
+                self.test_done(test)
+                continue
+
+            fixture = self.fixtures.get(test.suite)
+            if fixture and fixture.state == 'failed':
+                self.pending.popleft()
+                self.setup_failed(test, fixture)
+                continue
+
+            group = test.serial_group
+            if group is not None and group in self.group_running:
+                self.pending.popleft()
+                self.group_waiting.setdefault(group, collections.deque()).append(test)
+                continue
+
+            if not self.fits(test):
+                break
+
+            self.pending.popleft()
+            if fixture and fixture.state != 'ready':
+                self.waiting.setdefault(test.suite, []).append(test)
+                if fixture.state is None:
+                    fixture.start_setup(self.supervisor)
+                    self.fixture_started(fixture)
+                if group is not None:
+                    self.release_group(group)
+                continue
+
+            if self.generate:
+                test.start_generate(self.supervisor)
+            else:
+                test.start(self.supervisor)
+            self.running.append(test)
+            if group is not None:
+                self.group_running[group] = test
+
+    def fits(self, test):
+        """Check if test can start along with the running tests"""
+        if not self.running:
+            return True
+        if test.exclusive or [t for t in self.running if t.exclusive]:
+            return False
+
+        slots = sum([t.slots for t in self.running])
+        if slots + min(test.slots, self.jobs) > self.jobs:
+            return False
+
+        if self.max_memory and test.memory:
+            memory = sum([t.memory for t in self.running])
+            if memory + min(test.memory, self.max_memory) > self.max_memory:
+                return False
+
+        return not self.machine_overloaded()
+
+    def machine_overloaded(self):
+        """Check if the load average or the available memory is beyond the
+limits, at most every LOAD_CHECK_INTERVAL seconds"""
+        if not MAX_LOAD and not MIN_FREE_MEMORY:
+            return False
+
+        now = monotonic()
+        if self.load_checked is None or now - self.load_checked >= LOAD_CHECK_INTERVAL:
+            self.load_checked = now
+            self.overloaded = False
+            if MAX_LOAD and os.getloadavg()[0] > MAX_LOAD:
+                self.overloaded = True
+            if MIN_FREE_MEMORY:
+                available = available_memory()
+                if available is not None and available < MIN_FREE_MEMORY:
+                    self.overloaded = True
+
+        return self.overloaded
+
+    def release_group(self, group):
+        """Let the next test of the serial group be started, unless a test
+of the group is running"""
+        waiting = self.group_waiting.get(group)
+        if group not in self.group_running and waiting:
+            self.pending.appendleft(waiting.popleft())
+
+    def test_done(self, test):
+        group = test.serial_group
+        if group is not None:
+            if self.group_running.get(group) is test:
+                del self.group_running[group]
+            self.release_group(group)
+
+        fixture = self.fixtures.get(test.suite)
+        if fixture:
+            self.remaining[test.suite] -= 1
+            if not self.remaining[test.suite] and fixture.state == 'ready':
+                fixture.start_teardown(self.supervisor)
+                self.fixture_started(fixture)
+
+        if test.errors and self.errexit:
+            self.cancelled = True
+
+    def fixture_started(self, fixture):
+        if fixture.running:
+            self.running.append(fixture)
+        else:
+            #Failed to start, or there was nothing to run
+            self.fixture_done(fixture)
+
+    def fixture_done(self, fixture):
+        if fixture.state == 'ready':
+            self.pending.extendleft(reversed(self.waiting.pop(fixture.suite, [])))
+        elif fixture.state == 'failed':
+            for test in self.waiting.pop(fixture.suite, []):
+                self.setup_failed(test, fixture)
+        elif fixture.state == 'done' and fixture.teardown_error:
+            test = self.last_test[fixture.suite]
+            test.result = TestResult.FAIL()
+            test.errors.append(TestFailure(test, 'Teardown of suite %s failed:\n%s'
+                                                 % (fixture.suite,
+                                                    fixture.teardown_error)))
+
+    def setup_failed(self, test, fixture):
+        test.start_time = test.end_time = monotonic()
+        test.result = TestResult.FAIL()
+        test.errors.append(TestFailure(test, 'Setup of suite %s failed:\n%s' %
+                                             (fixture.suite, fixture.error)))
+        self.test_done(test)
+
+    def tearing_down(self, test):
+        """Check if test is the last test of a suite whose teardown has not
+completed, the result of the teardown is part of the result of the test"""
+        fixture = self.fixtures.get(test.suite)
+        return (fixture is not None and self.last_test[test.suite] is test and
+                fixture.state in ('ready', 'teardown'))
+
+    def wait(self, test):
+        """Run tests until the given test has completed. Returns False
+if the test was cancelled before it was started"""
+        while True:
+            self.schedule()
+            if test.finished and (self.cancelled or
+                                  not self.tearing_down(test)):
+                return True
+            if self.cancelled and not test.finished and test not in self.running:
+                #No more tests are started once cancelled
+                return False
+
+            self.supervisor.poll()
+
+    def shutdown(self):
+        self.cancelled = True
+        #Let running setup and teardown commands complete, so everything
+        #that was set up is torn down
+        while [f for f in self.fixtures.values() if f.running]:
+            self.supervisor.poll()
+        self.supervisor.kill_all()
+        #Tear down the suites that were set up, also when stopped early
+        for fixture in self.fixtures.values():
+            if fixture.state == 'ready':
+                fixture.start_teardown(self.supervisor)
+        self.supervisor.run()
+
+class ResultCache(object):
+    """Remembers a fingerprint of the inputs of the tests that passed,
+so the tests can be skipped as long as the inputs are unchanged"""
+
+    def __init__(self, filename, defines):
+        self.filename = filename
+        self.defines = defines
+        self.fingerprints = read_json(filename, {})
+        self.digests = {}
+
+    def file_digest(self, filename):
+        if filename not in self.digests:
+            h = hashlib.sha256()
+            try:
+                with open(filename, 'rb') as f:
+                    for chunk in iter(lambda: f.read(COMPARE_CHUNK_SIZE), b''):
+                        h.update(chunk)
+                self.digests[filename] = h.hexdigest()
+            except (IOError, OSError):
+                self.digests[filename] = 'missing'
+
+        return self.digests[filename]
+
+    def fingerprint(self, test):
+        """Hash of the command, defines, success codes, expected output,
+dependencies and suite fixture of the test"""
+        inputs = [test.cmd,
+                  test.cwd,
+                  repr(sorted(self.defines.items())),
+                  repr(test.success_codes),
+                  repr(test.timeout),
+                  repr(test.shell),
+                  repr(test.limits)]
+        fixture = SUITE_FIXTURES.get(test.suite)
+        if fixture:
+            inputs.extend([fixture.setup, fixture.teardown or ''])
+        for filename in test.input_files():
+            inputs.append('%s=%s' % (filename, self.file_digest(filename)))
+        inputs.extend(test.settings())
+
+        return hashlib.sha256('\0'.join(inputs).encode('utf-8')).hexdigest()
+
+    def passed(self, test):
+        """Check if the test passed earlier with the same inputs"""
+        return self.fingerprints.get(test.name) == self.fingerprint(test)
+
+    def update(self, test):
+        if test.result == TestResult.PASS():
+            self.fingerprints[test.name] = self.fingerprint(test)
+        elif test.result != TestResult.CACHED():
+            self.fingerprints.pop(test.name, None)
+
+    def save(self):
+        write_json(self.filename, self.fingerprints)
+
+class DurationHistory(object):
+    """The durations of the tests from earlier runs"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.durations = read_json(filename, {})
+
+    def estimate(self, test, default=0.0):
+        return self.durations.get(test.name, default)
+
+    def longest_first(self, tests):
+        """Sorts the tests on their last duration, longest first. Tests
+without a recorded duration are estimated to take the average time"""
+        average = 0.0
+        if self.durations:
+            average = sum(self.durations.values()) / len(self.durations)
+
+        return sorted(tests, key=lambda t: -self.estimate(t, average))
+
+    def update(self, test):
+        if test.result != TestResult.CACHED():
+            self.durations[test.name] = test.duration
+
+    def save(self):
+        write_json(self.filename, self.durations)
+
+class FailureHistory(object):
+    """The tests that failed or timed out the last time they were run,
+with a summary of each of their failures"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.failures = read_json(filename, {})
+
+    def update(self, test):
+        if test.errors:
+            self.failures[test.name] = {
+                'suite': test.suite,
+                'result': str(test.result),
+                'errors': [summarize_failure(e.msg) for e in test.errors]}
+        else:
+            self.failures.pop(test.name, None)
+
+    def save(self):
+        write_json(self.filename, self.failures)
+
+def summarize_failure(msg):
+    if len(msg) > FAILURE_SUMMARY_SIZE:
+        return msg[:FAILURE_SUMMARY_SIZE] + '\n... truncated\n'
+    return msg
+
+class Profiler(object):
+    """Collects the time spent in each phase of running the tests, in
+total and for each test"""
+
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.tests = []
+
+    def add(self, phase, elapsed, test=None):
+        self.totals[phase] = self.totals.get(phase, 0.0) + elapsed
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+        if test is not None:
+            if not test.profile:
+                self.tests.append(test)
+            test.profile[phase] = test.profile.get(phase, 0.0) + elapsed
+
+    def report(self, out, num_tests=20):
+        phases = sorted(self.totals, key=lambda p: -self.totals[p])
+        out.write('\n## Profile, time per phase:\n')
+        out.write('  %-24s %12s %8s %12s\n' % ('Phase', 'Total sec.',
+                                               'Count', 'Mean sec.'))
+        for phase in phases:
+            out.write('  %-24s %12.6f %8d %12.6f\n' % (phase, self.totals[phase],
+                      self.counts[phase], self.totals[phase] / self.counts[phase]))
+
+        #wait is the test command itself, the other phases are overhead
+        overhead = lambda t: sum([v for (k, v) in t.profile.items() if k != 'wait'])
+        tests = sorted(self.tests, key=lambda t: -overhead(t))[:num_tests]
+        if tests:
+            out.write('\n## Profile, the %d tests with the most overhead:\n' % len(tests))
+            for test in tests:
+                out.write('  %s: %s\n' % (test.name, format_profile(test.profile)))
+        out.flush()
+
+def format_profile(profile):
+    return ', '.join(['%s %.6f sec.' % (phase, profile[phase])
+                      for phase in sorted(profile)])
+
+def profile(phase, start, test=None):
+    """Adds the time since start to phase when profiling"""
+    if PROFILER:
+        PROFILER.add(phase, monotonic() - start, test)
+
+def run_tests(log, verbose=False, errexit=False, jobs=1, result_cache=None,
+              history=None, slowest=0, failures=None, first=None):
+    global RUN_DIR
+
     num_tests = 0
     num_failures = 0
     current_suite = None
+    completed = []
 
+    RUN_DIR = make_run_dir(WORKDIR)
+    executor = TestExecutor(jobs, errexit, result_cache, history, first=first)
     log.begin()
+    executor.start(ALL_TESTS)
 
-    for test in ALL_TESTS:
-        num_tests += 1
+    try:
+        for test in ALL_TESTS:
+            if jobs > 1 and not executor.wait(test):
+                continue
 
-        if test.suite != current_suite:
-            log.start_suite(test.suite)
-            current_suite = test.suite
+            num_tests += 1
 
-        log.start_test(test)
+            if test.suite != current_suite:
+                log.start_suite(test.suite)
+                current_suite = test.suite
 
-        test.run_test()
-        if test.errors:
-            num_failures += 1
+            log.start_test(test)
 
-        log.end_test(test)
-
-        if test.errors and errexit:
-            break
+            if jobs == 1:
+                executor.wait(test)
 
+            if test.errors:
+                num_failures += 1
+
+            log.end_test(test)
+            completed.append(test)
+
+            if result_cache:
+                result_cache.update(test)
+            if history:
+                history.update(test)
+            if failures:
+                failures.update(test)
+
+            if test.errors and errexit:
+                break
+    finally:
+        executor.shutdown()
+        remove_run_dir(RUN_DIR, keep_failures=True)
+        if result_cache:
+            result_cache.save()
+        if history:
+            history.save()
+        if failures:
+            failures.save()
+
+    if slowest:
+        completed.sort(key=lambda t: -t.duration)
+        log.slowest(completed[:slowest])
 
     log.end(num_tests, num_failures)
 
     return num_tests, num_failures
 
-def generate_test_files(errexit=False):
+def run_dir_base(workdir):
+    """The directory to create the run directories in, workdir or by
+default on tmpfs when available"""
+    if workdir is None:
+        workdir = tempfile.gettempdir()
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            workdir = '/dev/shm'
+    return workdir
+
+def make_run_dir(workdir):
+    """Creates a directory with a unique name for the files written in
+this run, and removes the ones left by earlier runs"""
+    global RUN_DIR_LOCK
+
+    workdir = run_dir_base(workdir)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    prune_run_dirs(workdir)
+
+    run_dir = tempfile.mkdtemp(prefix='testrunner-', dir=workdir)
+    with open(os.path.join(run_dir, RUN_DIR_OWNER), 'w') as f:
+        f.write(os.getcwd())
+
+    #An earlier run by this process, e.g. with --watch, is over
+    if RUN_DIR_LOCK is not None:
+        os.close(RUN_DIR_LOCK)
+    RUN_DIR_LOCK = os.open(run_dir, os.O_RDONLY)
+    fcntl.flock(RUN_DIR_LOCK, fcntl.LOCK_EX)
+    return run_dir
+
+def prune_run_dirs(workdir):
+    """Removes the run directories in workdir left by earlier runs from
+the current directory. Directories of runs still going on are locked,
+and left alone"""
+    try:
+        names = os.listdir(workdir)
+    except OSError:
+        return
 
-    num_failures = 0
-    for test in ALL_TESTS:
-        sys.stdout.write('Regenerating %s with command: %s\n' % (test.name,
-                                                               test.cmd))
+    cwd = os.getcwd()
+    for name in names:
+        if not name.startswith('testrunner-'):
+            continue
+        run_dir = os.path.join(workdir, name)
         try:
-            test.generate()
-        except Exception as ex:
-            sys.stdout.write('%s failed: %s\n' % (test.name, str(ex)))
-            num_failures += 1
+            with open(os.path.join(run_dir, RUN_DIR_OWNER)) as f:
+                if f.read() != cwd:
+                    continue
+            fd = os.open(run_dir, os.O_RDONLY)
+        except (IOError, OSError):
+            #Not a run directory of this user
+            continue
 
-        if num_failures > 0 and errexit:
-            break
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            shutil.rmtree(run_dir, ignore_errors=True)
+        except (IOError, OSError):
+            pass
+        finally:
+            os.close(fd)
+
+def remove_run_dir(run_dir, keep_failures=False):
+    """Removes the run directory and everything in it, unless it holds
+the output of failed tests to keep"""
+    if keep_failures and [f for f in os.listdir(run_dir) if f != RUN_DIR_OWNER]:
+        return
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+def generate_test_files(errexit=False, jobs=1, history=None):
+
+    num_failures = 0
+    changed_files = []
+    #Decided up front, as generating writes the files generates() checks
+    kept = set(t.name for t in ALL_TESTS if not t.generates())
+    executor = TestExecutor(jobs, errexit, history=history, generate=True)
+    executor.start([t for t in ALL_TESTS if t.name not in kept])
+
+    try:
+        for test in ALL_TESTS:
+            if test.name in kept:
+                sys.stdout.write('Keeping the baseline %s of %s, use '
+                                 '--rebaseline to overwrite it\n' %
+                                 (test.baseline_name, test.name))
+                continue
+            if jobs > 1 and not executor.wait(test):
+                continue
+
+            sys.stdout.write('Regenerating %s with command: %s\n' % (test.name,
+                                                                   test.cmd))
+            sys.stdout.flush()
+            if jobs == 1:
+                executor.wait(test)
+
+            for err in test.errors:
+                sys.stdout.write('%s failed: %s\n' % (test.name, err.msg))
+            if test.errors:
+                num_failures += 1
+            changed_files.extend(test.changed_files)
+
+            if num_failures > 0 and errexit:
+                break
+    finally:
+        executor.shutdown()
+
+    if changed_files:
+        sys.stdout.write('\nChanged output files:\n')
+        for filename in changed_files:
+            sys.stdout.write('  %s\n' % filename)
+    else:
+        sys.stdout.write('\nNo output files changed\n')
 
     return num_failures == 0
 
-def timedelta_total_seconds(t):
-    """Total seconds in the duration.
-Needed since timedelta.total_seconds() doesn't exist in Python 2.6"""
-    return ((t.days * 86400.0 + t.seconds)*10.0**6 + t.microseconds) / 10.0**6 
+def test_definition(test):
+    """Everything that defines how a test is run, to find the tests that
+changed when the testsuite files are loaded again"""
+    fixture = SUITE_FIXTURES.get(test.suite)
+    if fixture:
+        fixture = (fixture.setup, fixture.teardown, fixture.timeout)
+    return (test.cmd, test.cwd, test.suite, test.success_codes, test.timeout,
+            test.deps, test.shell, test.limits, test.settings(),
+            fixture)
+
+def watched_files(testfiles, tests):
+    """Maps the expected output files and the deps of the tests to the
+names of the tests using them, and the testsuite files to None"""
+    files = dict((f, None) for f in testfiles)
+    for test in tests:
+        for filename in test.input_files():
+            if files.get(filename, []) is not None:
+                files.setdefault(filename, []).append(test.name)
+    return files
+
+def file_stamp(filename):
+    try:
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+def wait_for_changes(stamps):
+    """Polls the files in stamps until any of them is changed, created or
+removed. Returns the changed files and the new stamps"""
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        current = dict((f, file_stamp(f)) for f in stamps)
+        changed = [f for f in stamps if current[f] != stamps[f]]
+        if changed:
+            return (changed, current)
+
+def watch_tests(options, args, defines, jobs, history, result_cache,
+                failures=None, last_failed=None):
+    """Runs the tests, and then runs the tests affected by changes to the
+testsuite files, the expected output files and the deps of the tests
+until interrupted. Returns True if the last run passed"""
+    global ALL_TESTS
+
+    tests = ALL_TESTS
+    files = watched_files(args, tests)
+    stamps = dict((f, file_stamp(f)) for f in files)
+    ok = True
+    try:
+        run = tests
+        while True:
+            if run:
+                for test in run:
+                    test.reset()
+                #Only the output of the last run is of interest
+                if RUN_DIR:
+                    remove_run_dir(RUN_DIR)
+                #The inputs may have changed since the last run
+                if result_cache:
+                    result_cache.digests.clear()
+                ALL_TESTS = run
+                (total, failed) = run_tests(create_log(options),
+                                            errexit=options.errexit,
+                                            jobs=jobs,
+                                            result_cache=result_cache,
+                                            history=history,
+                                            slowest=options.slowest,
+                                            failures=failures,
+                                            first=first_tests(options,
+                                                              last_failed))
+                ALL_TESTS = tests
+                ok = failed == 0
+            elif run is not None:
+                sys.stdout.write('No tests are affected by the changes\n')
+
+            sys.stdout.write('\n## Watching %d files for changes, '
+                             'press Ctrl-C to stop\n' % len(files))
+            sys.stdout.flush()
+            (changed, stamps) = wait_for_changes(stamps)
+
+            affected = set()
+            if [f for f in changed if files[f] is None]:
+                old = dict((t.name, test_definition(t)) for t in tests)
+                saved = (dict(TESTS_BY_NAME), dict(SUITE_FIXTURES))
+                try:
+                    load_tests(options, args, defines, last_failed)
+                except Exception:
+                    #Keep the tests as they were until the error is fixed
+                    traceback.print_exc()
+                    ALL_TESTS = tests
+                    TESTS_BY_NAME.clear()
+                    TESTS_BY_NAME.update(saved[0])
+                    SUITE_FIXTURES.clear()
+                    SUITE_FIXTURES.update(saved[1])
+                    run = None
+                    continue
+
+                tests = ALL_TESTS
+                for test in tests:
+                    if old.get(test.name) != test_definition(test):
+                        affected.add(test.name)
+                files = watched_files(args, tests)
+                stamps = dict((f, stamps.get(f, file_stamp(f))) for f in files)
+
+            for filename in changed:
+                affected.update(files.get(filename) or [])
+            run = [t for t in tests if t.name in affected]
+    except KeyboardInterrupt:
+        sys.stdout.write('\n')
+
+    return ok
 
 def execpyfile(filename, defines):
+    exec_globals = defines.copy()
+    exec_globals.update({'DefTest': DefTest, 'DefSuite': DefSuite,
+                         'DefFixture': DefFixture,
+                         'DefBenchmark': DefBenchmark})
+    exec_globals.update(defines)
+    code = load_code(filename)
+    exec(code, exec_globals, None)
+
+def cache_file(*names):
+    """Returns the path of a file in the cache directory, creating the
+directories leading up to it. Returns None if caching is disabled"""
+    if not CACHE_DIR:
+        return None
+
+    path = os.path.join(CACHE_DIR, *names)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+
+    return path
+
+def load_code(filename):
+    """Compiles the testsuite file. The compiled code is saved in the
+cache directory and reused as long as the file is unchanged"""
+    st = os.stat(filename)
+    #The filename as given is part of the key, as it's compiled into the
+    #code and used to find the directory of the tests
+    key = (filename, os.path.abspath(filename), st.st_mtime, st.st_size,
+           sys.version)
+    digest = hashlib.sha1(repr(key[:2]).encode('utf-8')).hexdigest()
+    cache_name = cache_file('bytecode', digest)
+
+    if cache_name:
+        try:
+            with open(cache_name, 'rb') as f:
+                if marshal.load(f) == key:
+                    return marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
     with open(filename) as f:
-        exec_globals = defines.copy()
-        exec_globals.update({'DefTest': DefTest, 'DefSuite': DefSuite})
-        exec_globals.update(defines)
         code = compile(f.read(), filename, 'exec')
-        exec(code, exec_globals, None)
+
+    #A file modified within the mtime granularity could be changed again
+    #without changing the mtime, only cache files that have settled
+    if cache_name and time.time() - st.st_mtime > 2:
+        tmp_name = '%s.%d' % (cache_name, os.getpid())
+        try:
+            with open(tmp_name, 'wb') as f:
+                marshal.dump(key, f)
+                marshal.dump(code, f)
+            os.rename(tmp_name, cache_name)
+        except (IOError, OSError):
+            silentremove(tmp_name)
+
+    return code
+
+def read_json(filename, default):
+    """Reads a JSON file, returns default if the file can't be read"""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+def write_json(filename, data):
+    """Replaces the JSON file atomically, so concurrent runs never read a
+partially written file. Does nothing if filename is None"""
+    if not filename:
+        return
+
+    tmp_name = '%s.%d' % (filename, os.getpid())
+    try:
+        with open(tmp_name, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_name, filename)
+    except (IOError, OSError):
+        silentremove(tmp_name)
 
 def silentremove(filename):
     try:
@@ -498,6 +2479,7 @@ def clean():
     silentremove(LOGFILE)
     for test in ALL_TESTS:
         test.cleanup()
+    prune_run_dirs(run_dir_base(WORKDIR))
 
 def list_tests():
     if ALL_TESTS:
@@ -513,15 +2495,285 @@ def list_tests():
     else:
         sys.stdout.write('No tests found\n')
 
-def filter_tests(keywords, getter):
+REGEXP_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+#Inline flags like (?i), which would apply to all the combined patterns
+INLINE_FLAGS = re.compile(r'\(\?[aiLmsux]')
+
+def is_literal(pattern):
+    return not REGEXP_SPECIAL_CHARS.intersection(pattern)
+
+def pattern_matcher(patterns):
+    """Returns a function that checks if a string is matched by any of the
+regexp patterns. Patterns on the form ^name$ are looked up in a set,
+the other patterns are combined into a single regexp where possible"""
+    exact = set()
+    combined = []
+    separate = []
+    for pattern in patterns:
+        re.compile(pattern) #Report invalid patterns as they were given
+        if (len(pattern) > 1 and pattern.startswith('^') and
+                pattern.endswith('$') and is_literal(pattern[1:-1])):
+            exact.add(pattern[1:-1])
+        elif ('(?P' in pattern or re.search(r'\\[1-9]', pattern) or
+              INLINE_FLAGS.search(pattern)):
+            #Group names and numbers would clash in a combined regexp, and
+            #inline flags would apply to the other patterns
+            separate.append(re.compile(pattern))
+        else:
+            combined.append(pattern)
+
+    if combined:
+        try:
+            separate.append(re.compile('|'.join(['(?:%s)' % p for p in combined])))
+        except re.error:
+            #Patterns that are only valid on their own
+            separate.extend([re.compile(p) for p in combined])
+
+    def matches(value):
+        if value in exact:
+            return True
+        for r in separate:
+            if r.search(value):
+                return True
+        return False
+
+    return matches
+
+def filter_tests(patterns, getter):
+    """Keep the tests where any of the patterns matches getter(test),
+in the order the tests were defined"""
     global ALL_TESTS
 
-    filtered_tests = []
-    for include in keywords:
-        r = re.compile(include)
-        filtered_tests += [t for t in ALL_TESTS if r.search(getter(t)) and t not in filtered_tests]
+    matches = pattern_matcher(patterns)
+    ALL_TESTS = [t for t in ALL_TESTS if matches(getter(t))]
+
+def select_failed(failed):
+    """Keep the tests named in failed, or all the tests when none of them
+failed"""
+    global ALL_TESTS
+
+    tests = [t for t in ALL_TESTS if t.name in failed]
+    if tests:
+        ALL_TESTS = tests
+
+def shard_tests(shard, num_shards, history=None):
+    """Keep the tests of shard number shard, 1 to num_shards. The tests
+are balanced over the shards on their durations in the history when it
+has the duration of every test, otherwise they are spread on a hash of
+their names. Any other mix would depend on which tests the history of
+each shard happens to have"""
+    global ALL_TESTS
+
+    assignment = {}
+    if history and not [t for t in ALL_TESTS
+                        if t.name not in history.durations]:
+        #Longest first onto the least loaded shard, ties broken on the
+        #name so every shard computes the same assignment
+        loads = [0.0] * num_shards
+        timed = sorted(ALL_TESTS,
+                       key=lambda t: (-history.durations[t.name], t.name))
+        for test in timed:
+            least_loaded = loads.index(min(loads))
+            loads[least_loaded] += history.durations[test.name]
+            assignment[test.name] = least_loaded
+    else:
+        for test in ALL_TESTS:
+            digest = hashlib.md5(test.name.encode('utf-8')).hexdigest()
+            assignment[test.name] = int(digest, 16) % num_shards
 
-    ALL_TESTS = filtered_tests
+    ALL_TESTS = [t for t in ALL_TESTS if assignment[t.name] == shard - 1]
+
+def parse_shard(shard):
+    (k, sep, n) = shard.partition('/')
+    try:
+        (k, n) = (int(k), int(n))
+    except ValueError:
+        (k, n) = (0, 0)
+
+    if not sep or n < 1 or k < 1 or k > n:
+        sys.stdout.write("Error shard '%s' is not on the form K/N with 1 <= K <= N\n" % shard)
+        sys.exit(1)
+
+    return (k, n)
+
+RESOURCES_PATTERN = re.compile(r'CPU user ([\d.]+) sec., system ([\d.]+) sec., ' +
+                               r'max RSS (\d+) kB, blocks in (\d+), out (\d+), ' +
+                               r'context switches (\d+)/(\d+)')
+
+def parse_resources(text):
+    m = RESOURCES_PATTERN.search(text)
+    if not m:
+        return None
+
+    values = m.groups()
+    usage = {'user_time':   float(values[0]),
+             'system_time': float(values[1])}
+    for (i, key) in enumerate(['max_rss', 'blocks_in', 'blocks_out',
+                               'voluntary_ctx', 'involuntary_ctx']):
+        usage[key] = int(values[i + 2])
+
+    return usage
+
+BENCHMARK_PATTERN = re.compile(r'wall min ([\d.]+) median ([\d.]+) p95 ([\d.]+) sec., ' +
+                               r'CPU min ([\d.]+) median ([\d.]+) p95 ([\d.]+) sec., ' +
+                               r'(\d+) runs')
+
+def parse_benchmark(text):
+    m = BENCHMARK_PATTERN.search(text)
+    if not m:
+        return None
+
+    values = m.groups()
+    stats = {'runs': int(values[6])}
+    for (i, key) in enumerate(['wall_min', 'wall_median', 'wall_p95',
+                               'cpu_min', 'cpu_median', 'cpu_p95']):
+        stats[key] = float(values[i])
+
+    return stats
+
+def parse_result(text):
+    return getattr(TestResult, text.strip(), TestResult.NOTRUN)()
+
+def read_text_log(f):
+    tests = []
+    suite = 'default'
+    test = None
+    errors = None
+    for line in f:
+        if line.startswith('## Running testsuite: '):
+            suite = line[len('## Running testsuite: '):].rstrip('\n')
+            test = errors = None
+        elif line.startswith('## Test: '):
+            test = LoggedTest(line[len('## Test: '):].rstrip('\n'), suite)
+            tests.append(test)
+            errors = None
+        elif test is None:
+            continue
+        elif errors is not None:
+            #Everything up to the next test or suite belongs to the failures,
+            #except the summary written at the end of the log
+            if re.match(r'(## \d+ slowest tests:|\d+ of \d+ tests failed$|All \d+ tests passed$)',
+                        line):
+                test = None
+            else:
+                errors.append(line)
+                test.errors = [LoggedError(''.join(errors).strip('\n'))]
+        elif line.startswith('## Command: '):
+            test.cmd = line[len('## Command: '):].rstrip('\n')
+        elif line.startswith('## Duration: '):
+            test.duration = float(line.split()[2])
+        elif line.startswith('## Resources: '):
+            test.rusage = parse_resources(line)
+        elif line.startswith('## Benchmark: '):
+            test.benchmark = parse_benchmark(line)
+        elif line.startswith('## Result: '):
+            test.result = parse_result(line[len('## Result: '):])
+        elif line.startswith('## ') and line.rstrip().endswith(' failures:'):
+            m = re.match(r'## .* at (.*):(\d+) failures:$', line.rstrip())
+            if m:
+                test.filename = m.group(1)
+                test.lineno = int(m.group(2))
+            errors = []
+
+    return tests
+
+def read_xml_log(f):
+    tests = []
+    root = ElementTree.parse(f).getroot()
+    for suite in root.findall('testsuite'):
+        for testcase in suite.findall('testcase'):
+            test = LoggedTest(testcase.get('name'), suite.get('name'))
+            test.duration = float(testcase.findtext('duration', '0'))
+            test.result = parse_result(testcase.findtext('result', ''))
+            resources = testcase.find('resources')
+            if resources is not None:
+                test.rusage = {}
+                for (key, value) in resources.attrib.items():
+                    test.rusage[key] = float(value) if key.endswith('_time') else int(value)
+            benchmark = testcase.find('benchmark')
+            if benchmark is not None:
+                test.benchmark = {}
+                for (key, value) in benchmark.attrib.items():
+                    test.benchmark[key] = int(value) if key == 'runs' else float(value)
+            for error in testcase.findall('errors/error'):
+                test.errors.append(LoggedError(error.text or ''))
+            tests.append(test)
+
+    return tests
+
+def read_json_log(f):
+    tests = []
+    for line in f:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record.get('type') != 'test':
+            continue
+
+        test = LoggedTest(record['name'], record['suite'])
+        test.cmd = record.get('command', '')
+        test.filename = record.get('file', '')
+        test.lineno = record.get('line', 0)
+        test.result = parse_result(record.get('result', ''))
+        test.duration = record.get('duration', 0.0)
+        test.exitcode = record.get('exit_code')
+        test.rusage = record.get('resources')
+        test.benchmark = record.get('benchmark')
+        for msg in record.get('errors', []):
+            test.errors.append(LoggedError('%s %s:\n%s' % (test.result,
+                                                          test.name, msg)))
+        tests.append(test)
+
+    return tests
+
+def read_log(filename):
+    """Reads the test results from a text, XML or JSON Lines log file"""
+    with open(filename) as f:
+        start = f.read(1)
+        f.seek(0)
+        if start == '<':
+            return read_xml_log(f)
+        elif start == '{':
+            return read_json_log(f)
+        else:
+            return read_text_log(f)
+
+def read_logs(filenames):
+    """Reads the tests of all the log files, grouped by suite. Returns the
+suites in the order first seen and the tests of each suite"""
+    suites = []
+    tests_by_suite = {}
+    log_of_test = {}
+    for filename in filenames:
+        for test in read_log(filename):
+            if test.name in log_of_test:
+                sys.stdout.write("Warning: the test '%s' is in both %s and %s\n" %
+                                 (test.name, log_of_test[test.name], filename))
+            log_of_test[test.name] = filename
+            if test.suite not in tests_by_suite:
+                suites.append(test.suite)
+                tests_by_suite[test.suite] = []
+            tests_by_suite[test.suite].append(test)
+    return suites, tests_by_suite
+
+def merge_logs(suites, tests_by_suite, log):
+    """Reports the tests read by read_logs() as a single run. Returns the
+number of tests and failures"""
+    num_tests = 0
+    num_failures = 0
+    log.begin()
+    for suite in suites:
+        log.start_suite(suite)
+        for test in tests_by_suite[suite]:
+            num_tests += 1
+            if test.errors or test.result in (TestResult.FAIL(),
+                                              TestResult.TIMEDOUT()):
+                num_failures += 1
+            log.start_test(test)
+            log.end_test(test)
+
+    log.end(num_tests, num_failures)
+    return num_tests, num_failures
 
 def parse_defines(defines):
     defines_dict = {}
@@ -534,8 +2786,53 @@ def parse_defines(defines):
 
     return defines_dict
 
+def parse_jobs(jobs):
+    if jobs == 'auto':
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    try:
+        num_jobs = int(jobs)
+    except ValueError:
+        num_jobs = 0
+
+    if num_jobs < 1:
+        sys.stdout.write("Error jobs '%s' is not a positive number or 'auto'\n" % jobs)
+        sys.exit(1)
+
+    return num_jobs
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(size):
+    """Parses a number of bytes, optionally with a K, M, G or T suffix"""
+    m = re.match(r'(\d+)([KMGT]?)B?$', size.strip().upper())
+    if not m:
+        sys.stdout.write("Error size '%s' is not a number of bytes, "
+                         "optionally with a K, M, G or T suffix\n" % size)
+        sys.exit(1)
+
+    return int(m.group(1)) * SIZE_SUFFIXES[m.group(2)]
+
+def create_log(options):
+    log = MultiDelegate()
+    if options.xml:
+        log.delegates.append(XMLLog(LOGFILE))
+    elif options.json:
+        log.delegates.append(JSONLog(LOGFILE))
+    else:
+        log.delegates.append(TextLog(LOGFILE, options.verbose))
+
+    log.delegates.append(TerminalLog(verbose=options.verbose, 
+                                     show_command=options.show_command))
+    return log
+
 def main():
     global DEFAULT_TEST_TIMEOUT
+    global CACHE_DIR
+    global MAX_DIFF_SIZE
     parser = optparse.OptionParser(usage='usage: %prog [options] test1 ...',
                                    version=VERSION)
     parser.add_option('-v', '--verbose',
@@ -572,6 +2869,9 @@ def main():
     parser.add_option('--xml',
                       action='store_true', dest='xml', default=False,
                       help='Write the logfile in XML format')
+    parser.add_option('--json',
+                      action='store_true', dest='json', default=False,
+                      help='Write the logfile in JSON Lines format')
     parser.add_option('-D', '--define',
                       action='append', dest='define', default=[],
                       help='Define a variable available to the  test files.' +
@@ -586,6 +2886,93 @@ def main():
                       action='store', dest='timeout', default=None,
                       help='Override default individual test timeout in seconds. ' +
                             'Does not affect tests that explicitly defined a timeout')
+    parser.add_option('--rebaseline',
+                      action='store_true', dest='rebaseline', default=False,
+                      help='With -g, also overwrite the existing baselines ' +
+                           'of benchmarks')
+    parser.add_option('--diff-files',
+                      action='store_true', dest='diff_files', default=False,
+                      help='Write the full output differences of failed ' +
+                           'tests to .stdout-diff/.stderr-diff files in the ' +
+                           'run directory')
+    parser.add_option('--workdir',
+                      action='store', dest='workdir', default=None,
+                      help='Create the run directory, where the output of ' +
+                           'failed tests is kept, in WORKDIR. Default /dev/shm ' +
+                           'or the temporary directory')
+    parser.add_option('--max-diff-size',
+                      action='store', dest='max_diff_size', type='int',
+                      default=MAX_DIFF_SIZE,
+                      help='Truncate the output differences shown and logged ' +
+                           'for a failed test after MAX_DIFF_SIZE bytes. ' +
+                           'Default %d' % MAX_DIFF_SIZE)
+    parser.add_option('--cache-dir',
+                      action='store', dest='cache_dir', default=CACHE_DIR,
+                      help='Directory where the testrunner caches data ' +
+                           'between runs. Default %s' % CACHE_DIR)
+    parser.add_option('--no-cache',
+                      action='store_true', dest='no_cache', default=False,
+                      help='Do not read or write the cache directory')
+    parser.add_option('-i', '--incremental',
+                      action='store_true', dest='incremental', default=False,
+                      help='Skip tests that passed in an earlier run with ' +
+                           'the same command, defines, expected output and ' +
+                           'dependencies')
+    parser.add_option('--slowest',
+                      action='store', dest='slowest', type='int', default=0,
+                      help='Report the SLOWEST number of slowest tests')
+    parser.add_option('--shard',
+                      action='store', dest='shard', default=None,
+                      help='Run only shard K of N shards of the tests, ' +
+                           'given as K/N')
+    parser.add_option('--shard-durations',
+                      action='store', dest='shard_durations', default=None,
+                      help='Balance the shards on the test durations in ' +
+                           'SHARD_DURATIONS, a durations.json file shared ' +
+                           'by all the shards')
+    parser.add_option('--merge',
+                      action='store_true', dest='merge', default=False,
+                      help='Merge the log files given as arguments into a ' +
+                           'single log instead of running tests')
+    parser.add_option('--profile',
+                      action='store_true', dest='profile', default=False,
+                      help='Measure the time spent in each phase of running ' +
+                           'the tests, and report it at the end')
+    parser.add_option('--profile-dump',
+                      action='store', dest='profile_dump', default=None,
+                      help='Write a cProfile dump of the testrunner to ' +
+                           'PROFILE_DUMP')
+    parser.add_option('--watch',
+                      action='store_true', dest='watch', default=False,
+                      help='Keep running, and run the tests again when ' +
+                           'their testsuite files, output files or deps change')
+    parser.add_option('--last-failed',
+                      action='store_true', dest='last_failed', default=False,
+                      help='Run only the tests that failed or timed out in ' +
+                           'the last run, or all the tests if none did')
+    parser.add_option('--failed-first',
+                      action='store_true', dest='failed_first', default=False,
+                      help='Start the tests that failed or timed out in ' +
+                           'the last run ahead of the other tests')
+    parser.add_option('--max-memory',
+                      action='store', dest='max_memory', default=None,
+                      help='Start tests in parallel only while the sum of ' +
+                           'their memory weights is within MAX_MEMORY bytes, ' +
+                           'with an optional K, M or G suffix. Default is ' +
+                           'the physical memory')
+    parser.add_option('--max-load',
+                      action='store', dest='max_load', type='float',
+                      default=None,
+                      help='Do not start more tests in parallel while the ' +
+                           'load average is above MAX_LOAD')
+    parser.add_option('--min-free-memory',
+                      action='store', dest='min_free_memory', default=None,
+                      help='Do not start more tests in parallel while less ' +
+                           'than MIN_FREE_MEMORY bytes of memory is available')
+    parser.add_option('-j', '--jobs',
+                      action='store', dest='jobs', default='1',
+                      help='Number of tests to run in parallel. ' +
+                           'JOBS is a number or auto to use one job per CPU')
 
     (options, args) =  parser.parse_args()
     if not args:
@@ -598,13 +2985,69 @@ def main():
         LOGFILE = options.logfile
     elif options.xml:
         LOGFILE='testsuite.xml'
+    elif options.json:
+        LOGFILE='testsuite.jsonl'
     else:
         LOGFILE='testsuite.log'
 
     if options.timeout:
         DEFAULT_TEST_TIMEOUT = options.timeout
 
-    defines = parse_defines(options.define)
+    global DIFF_FILES
+    DIFF_FILES = options.diff_files
+
+    global REBASELINE
+    REBASELINE = options.rebaseline
+
+    global WORKDIR
+    WORKDIR = options.workdir
+
+    global MAX_MEMORY
+    global MAX_LOAD
+    global MIN_FREE_MEMORY
+    if options.max_memory:
+        MAX_MEMORY = parse_size(options.max_memory)
+    MAX_LOAD = options.max_load
+    if options.min_free_memory:
+        MIN_FREE_MEMORY = parse_size(options.min_free_memory)
+
+    MAX_DIFF_SIZE = options.max_diff_size
+
+    if options.no_cache:
+        CACHE_DIR = None
+    else:
+        CACHE_DIR = options.cache_dir
+
+    global PROFILER
+    if options.profile:
+        PROFILER = Profiler()
+
+    if options.profile_dump:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+        try:
+            return run(options, args)
+        finally:
+            cprofile.disable()
+            cprofile.dump_stats(options.profile_dump)
+
+    return run(options, args)
+
+def reset_tests():
+    """Forget the tests loaded from the testsuite files"""
+    global ALL_TESTS
+    global CURRENT_SUITE
+
+    ALL_TESTS = []
+    TESTS_BY_NAME.clear()
+    SUITE_FIXTURES.clear()
+    CURRENT_SUITE = 'default'
+
+def load_tests(options, args, defines, last_failed=None):
+    """Loads the testsuite files, and keeps the tests selected by the
+options in ALL_TESTS. last_failed are the names of the tests that failed
+in the last run, for --last-failed and --failed-first"""
+    reset_tests()
     for testfile in args:
         execpyfile(testfile, defines)
 
@@ -614,6 +3057,55 @@ def main():
     if options.suite:
         filter_tests(options.suite, lambda t: t.suite)
 
+    if options.shard:
+        (shard, num_shards) = parse_shard(options.shard)
+        history = None
+        if options.shard_durations:
+            history = DurationHistory(options.shard_durations)
+        shard_tests(shard, num_shards, history)
+
+    if last_failed is not None and options.last_failed:
+        select_failed(last_failed)
+
+def first_tests(options, last_failed):
+    """The names of the tests the executor starts ahead of the others"""
+    if options.failed_first:
+        return last_failed
+    return None
+
+def run(options, args):
+    if options.merge:
+        # Read all the logs before create_log() truncates LOGFILE, which
+        # may be one of them
+        (suites, tests_by_suite) = read_logs(args)
+        log = create_log(options)
+        (total, failed) = merge_logs(suites, tests_by_suite, log)
+        if options.exit_success or failed == 0:
+            return 0
+        return 1
+
+    jobs = parse_jobs(options.jobs)
+    defines = parse_defines(options.define)
+
+    history = None
+    failures = None
+    last_failed = None
+    if CACHE_DIR:
+        history = DurationHistory(cache_file('durations.json'))
+        failures = FailureHistory(cache_file('lastfailed.json'))
+        last_failed = set(failures.failures)
+    elif options.last_failed or options.failed_first:
+        sys.stdout.write('--last-failed and --failed-first need the cache, '
+                         'the tests that failed are saved in it\n')
+        return 1
+
+    load_tests(options, args, defines, last_failed)
+
+    if options.last_failed and not [t for t in ALL_TESTS
+                                    if t.name in last_failed]:
+        sys.stdout.write('No failed tests recorded for the selected tests, '
+                         'running all of them\n')
+
     if options.clean:
         clean()
         return 0
@@ -629,18 +3121,29 @@ def main():
 
     ok = False
     if options.generate:
-        ok = generate_test_files(errexit=options.errexit)
+        ok = generate_test_files(errexit=options.errexit, jobs=jobs,
+                                 history=history)
     else:
-        log = MultiDelegate()
-        if options.xml:
-            log.delegates.append(XMLLog(LOGFILE))
-        else:
-            log.delegates.append(TextLog(LOGFILE, options.verbose))
+        result_cache = None
+        if options.incremental and CACHE_DIR:
+            result_cache = ResultCache(cache_file('results.json'), defines)
 
-        log.delegates.append(TerminalLog(verbose=options.verbose, 
-                                         show_command=options.show_command))
-        (total, failed) = run_tests(log, errexit=options.errexit)
-        ok = failed == 0
+        if options.watch:
+            ok = watch_tests(options, args, defines, jobs, history,
+                             result_cache, failures, last_failed)
+        else:
+            log = create_log(options)
+            (total, failed) = run_tests(log, errexit=options.errexit,
+                                        jobs=jobs,
+                                        result_cache=result_cache,
+                                        history=history,
+                                        slowest=options.slowest,
+                                        failures=failures,
+                                        first=first_tests(options,
+                                                          last_failed))
+            ok = failed == 0
+        if PROFILER:
+            PROFILER.report(sys.stdout)
 
     if options.exit_success or ok:
         return 0